@@ -1,10 +1,8 @@
-from fastapi import FastAPI, Query, BackgroundTasks, Request, Response, WebSocket, WebSocketDisconnect
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi import FastAPI, Query, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-import redis.asyncio as redis
-import json
 import os
 import asyncio
+import time
 from typing import List, Dict
 import logging
 import traceback
@@ -17,36 +15,75 @@ from services.recommendation import recommendation_service
 from services.firebase_db import firebase_db
 from services.spotify_recommender import spotify_recommender
 from services.device_manager import device_manager
+from services.cache import redis_client
+from services.ydl_pool import ydl_pool
+from services.stream_cache import stream_cache
+from services.extraction_engine import extraction_engine
+from services.prewarm import prewarm_scheduler, PRIORITY_SEARCH, PRIORITY_RECOMMENDATION
+from services.segment_cache import segment_cache, parse_range, RangeNotSatisfiable
+from services.stream_fanout import stream_fanout
+from services.youtube import StreamInfo
+from services.stream_upstream import stream_upstream, capture_stream_metadata, UPSTREAM_USER_AGENT
+from services.stream_pipeline import stream_pipeline, AudioStreamResponse
+from services.stream_prefix import stream_prefix
+from services.transcoder import transcoder, TRANSCODE_QUALITIES, TRANSCODE_MIME, TRANSCODE_OPEN_END
+from services.http_pool import http_pool
+from services.user_profile import profile_cache
+from services.codec import JSONResponse, dumps_text, loads_json
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# httpx_client will be initialized in lifespan
-httpx_client = None
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global httpx_client
-    import httpx
+    # Per-host outbound HTTP pools, resized in the background from observed concurrency
+    http_pool.start()
+    # Invalidation subscription for the in-process Redis near cache
+    redis_client.start()
+    logger.info(f"HTTP pool manager started (HTTP/2 {'enabled' if http_pool.http2 else 'unavailable'})")
+
+    # Stream extractions run in dedicated worker processes, which warm their own yt-dlp pool
     try:
-        httpx_client = httpx.AsyncClient(
-            timeout=httpx.Timeout(10.0, connect=5.0),
-            limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
-            follow_redirects=True
-        )
-        logger.info("Initializing HTTPX client on current event loop")
+        await extraction_engine.start()
+        logger.info(f"Extraction engine started with {extraction_engine.workers} workers")
+    except Exception as e:
+        logger.error(f"Failed to start extraction engine, extracting in-process: {e}")
+
+    # Pre-warm yt-dlp instances so the first search/extraction doesn't pay the cold start
+    try:
+        pools = ["search"] if extraction_engine.running else None
+        await asyncio.get_running_loop().run_in_executor(None, ydl_pool.warm, pools)
+        logger.info("yt-dlp pool warmed")
     except Exception as e:
-        logger.error(f"Failed to initialize HTTPX client: {e}")
+        logger.error(f"Failed to warm yt-dlp pool: {e}")
+
+    # Index audio segments already on disk from previous runs
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, segment_cache.load)
+    except Exception as e:
+        logger.error(f"Failed to index segment cache: {e}")
+
+    # Re-extracts hot stream URLs shortly before they expire
+    stream_cache.start()
+    prewarm_scheduler.start()
+    stream_prefix.start()
+    # Batched device heartbeat writes
+    device_manager.start()
     
     yield
     
-    if httpx_client:
-        await httpx_client.aclose()
+    await device_manager.stop()
+    await stream_prefix.stop()
+    await prewarm_scheduler.stop()
+    await stream_cache.stop()
+    await extraction_engine.stop()
+    await http_pool.aclose()
     if redis_client:
         await redis_client.close()
 
-app = FastAPI(lifespan=lifespan)
+# orjson-backed when available, also for endpoints that return plain dicts
+app = FastAPI(lifespan=lifespan, default_response_class=JSONResponse)
 logger.info("Starting SonicStream Backend...")
 
 
@@ -81,44 +118,6 @@ async def log_requests(request: Request, call_next):
         )
 
 
-# Safe Redis Wrapper
-class SafeRedis:
-    def __init__(self, url):
-        self.url = url
-        self.client = None
-        self._connect()
-
-    def _connect(self):
-        try:
-            self.client = redis.from_url(self.url, decode_responses=True, socket_timeout=5, socket_connect_timeout=5)
-            logger.info("Redis client initialized")
-        except Exception as e:
-            logger.error(f"Failed to initialize Redis client: {e}")
-            self.client = None
-
-    async def get(self, key):
-        if not self.client: return None
-        try:
-            return await self.client.get(key)
-        except Exception as e:
-            logger.error(f"Redis GET error: {e}")
-            return None
-
-    async def setex(self, key, time, value):
-        if not self.client: return False
-        try:
-            return await self.client.setex(key, time, value)
-        except Exception as e:
-            logger.error(f"Redis SETEX error: {e}")
-            return False
-
-    async def close(self):
-        if self.client:
-            await self.client.close()
-
-REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
-redis_client = SafeRedis(REDIS_URL)
-
 @app.get("/")
 @app.get("/health")
 def health():
@@ -128,42 +127,41 @@ def health():
 def version():
     return {"version": "v17-stability-fix"}
 
-async def prewarm_streams(video_ids: List[str]):
-    """Background task to fetch stream URLs for top results."""
-    for vid in video_ids:
-        try:
-            if not await redis_client.get(f"stream:{vid}"):
-                info = await yt_service.get_stream_url(vid)
-                if info and "url" in info:
-                    await redis_client.setex(f"stream:{vid}", 3600, info["url"])
-        except Exception as e:
-            print(f"Redis pre-warm failed/skipped: {e}")
+def prewarm_results(songs: List[Dict], priority: int, group: str = None, limit: int = 3):
+    """Queues the top uncached results for stream URL resolution."""
+    ids = [
+        s["id"] for s in songs
+        if s.get("id") and not s.get("stream_url") and not s.get("needs_resolution")
+    ]
+    if ids:
+        prewarm_scheduler.schedule(ids[:limit], priority=priority, group=group)
+
+async def enrich_stream_urls(songs: List[Dict]):
+    """Attaches cached stream URLs to results, fetched in one Redis round trip."""
+    cached = await stream_cache.get_many([s.get("id") for s in songs])
+    for song in songs:
+        info = cached.get(song.get("id"))
+        if info:
+            song["stream_url"] = info.url
+
+def prefetch_top_hits(songs: List[Dict], group: str = None, limit: int = 2):
+    """Holds the opening bytes of the top results in memory so a tap on them starts instantly."""
+    stream_prefix.schedule([s.get("id") for s in songs[:limit]], group=group)
 
 @app.api_route("/search", methods=["GET", "HEAD"])
-async def search_song(request: Request, background_tasks: BackgroundTasks, q: str = Query(...), user_id: str = "guest"):
+async def search_song(request: Request, q: str = Query(...), user_id: str = "guest"):
     try:
-        cache_key = f"search:{q.lower()}:{user_id}"
-        cached = await redis_client.get(cache_key)
-        
-        if cached:
-            results = json.loads(cached)
-        else:
-            results = await search_service.search_songs(q, user_id=user_id)
-            await redis_client.setex(cache_key, 3600, json.dumps(results))
-        
+        # Raw results are cached per canonical query inside search_service and
+        # re-ranked for this user on the way out
+        results = await search_service.search_songs(q, user_id=user_id)
+
         # Enrich with stream URLs and trigger pre-warm
-        vids = []
-        for song in results:
-            sid = song.get("id")
-            if sid:
-                cached_url = await redis_client.get(f"stream:{sid}")
-                if cached_url:
-                    song["stream_url"] = cached_url
-                elif len(vids) < 3:
-                    vids.append(sid)
-
-        if vids:
-            background_tasks.add_task(prewarm_streams, vids)
+        await enrich_stream_urls(results)
+
+        # A user's new search supersedes their previous prewarm jobs
+        group = None if user_id == "guest" else f"user:{user_id}"
+        prewarm_results(results, PRIORITY_SEARCH, group=group)
+        prefetch_top_hits(results, group=group)
         
         if request.method == "HEAD":
             return Response(status_code=200)
@@ -175,11 +173,7 @@ async def search_song(request: Request, background_tasks: BackgroundTasks, q: st
 
 @app.get("/suggestions")
 async def suggestions(q: str = Query(...), user_id: str = "guest"):
-    cache_key = f"suggest:{q.lower()}:{user_id}"
     try:
-        cached = await redis_client.get(cache_key)
-        if cached: return json.loads(cached)
-        
         results = await search_service.search_songs(q, limit=5, user_id=user_id)
         formatted = [{
             "id": s["id"],
@@ -187,97 +181,185 @@ async def suggestions(q: str = Query(...), user_id: str = "guest"):
             "thumbnail": s["thumbnail"],
             "duration": s["duration"]
         } for s in results]
-        
-        await redis_client.setex(cache_key, 1800, json.dumps(formatted))
         return formatted
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
+def stream_response_headers(stream_info: StreamInfo, start: int, end: int, ranged: bool) -> Dict[str, str]:
+    res_headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Type": stream_info.mime_type or "audio/mpeg",
+        "X-Accel-Buffering": "no",
+        "Cache-Control": "max-age=3600",
+        "Content-Length": str(end - start + 1),
+    }
+    if ranged:
+        res_headers["Content-Range"] = f"bytes {start}-{end}/{stream_info.content_length}"
+    return res_headers
+
+async def transcoded_response(request: Request, video_id: str, stream_info: StreamInfo, kbps: int, started: float):
+    """?quality= responses: Opus re-encoded from the (segment-cached) original bytes."""
+    total = stream_info.content_length
+    source_key = segment_cache.key(video_id, stream_info.itag, total)
+    fetch = stream_fanout.fetcher(source_key, stream_upstream.fetcher(video_id, stream_info))
+
+    def open_source():
+        return segment_cache.serve(source_key, 0, total - 1, total, fetch)
+
+    key = transcoder.key(source_key, kbps)
+    # Concurrent requests for the same encode share one ffmpeg process
+    fetch_encoded = stream_fanout.fetcher(key, transcoder.fetcher(key, open_source, kbps))
+    encoded_total = await transcoder.cached_length(key)
+    if encoded_total is None:
+        # First encode at this bitrate: the length isn't known until it finishes, so no ranges yet
+        headers = {"Content-Type": TRANSCODE_MIME, "Accept-Ranges": "none", "X-Accel-Buffering": "no"}
+        if request.method == "HEAD":
+            return Response(status_code=200, headers=headers)
+        return AudioStreamResponse(
+            stream_pipeline.pipe(video_id, fetch_encoded(0, TRANSCODE_OPEN_END), started),
+            status_code=200,
+            headers=headers,
+            media_type=TRANSCODE_MIME
+        )
+
+    range_header = request.headers.get("Range")
+    try:
+        byte_range = parse_range(range_header, encoded_total)
+    except RangeNotSatisfiable:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{encoded_total}"})
+    # No (or an invalid, hence ignored) Range header: the whole stream with a 200
+    ranged = byte_range is not None
+    start, end = byte_range or (0, encoded_total - 1)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Type": TRANSCODE_MIME,
+        "X-Accel-Buffering": "no",
+        "Cache-Control": "max-age=3600",
+        "Content-Length": str(end - start + 1),
+    }
+    if ranged:
+        headers["Content-Range"] = f"bytes {start}-{end}/{encoded_total}"
+    if request.method == "HEAD":
+        return Response(status_code=206 if ranged else 200, headers=headers)
+    return AudioStreamResponse(
+        stream_pipeline.pipe(video_id, segment_cache.serve(key, start, end, encoded_total, fetch_encoded), started),
+        status_code=206 if ranged else 200,
+        headers=headers,
+        media_type=TRANSCODE_MIME
+    )
+
 @app.api_route("/stream/{video_id}", methods=["GET", "HEAD"])
-async def stream_audio(request: Request, video_id: str):
-    audio_url = await redis_client.get(f"stream:{video_id}")
+async def stream_audio(request: Request, video_id: str, quality: str = None):
+    started = time.monotonic()
+    stream_info = await stream_cache.get(video_id)
     
-    if not audio_url:
-        info = await yt_service.get_stream_url(video_id)
-        if not info or "url" not in info:
+    if not stream_info:
+        # Cached until shortly before the URL's own expiry
+        stream_info = await stream_cache.extract(video_id)
+        if not stream_info:
             print(f"Extraction failed for {video_id}")
             return JSONResponse(status_code=500, content={"error": "Failed to extract stream URL"})
 
-        audio_url = info["url"]
-        # Cache for 1 hour
-        await redis_client.setex(f"stream:{video_id}", 3600, audio_url)
-
     # Proxying logic with global pooling and MIME normalization
-    import time
     start_time = time.time()
     
     range_header = request.headers.get("Range")
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36",
-        "Range": range_header
-    } if range_header else {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36"
-    }
+    # Players re-request later ranges while seeking or buffering; only the opening request is a play
+    new_playback = not range_header or range_header.replace(" ", "").startswith("bytes=0-")
 
     try:
-        # 1. HEAD request optimization: Just return headers, don't start stream generator
+        # 0. Reduced quality: Opus re-encode, unless ffmpeg is missing or the transcoders are backed up
+        kbps = TRANSCODE_QUALITIES.get(quality)
+        if kbps and transcoder.available:
+            if not stream_info.content_length:
+                try:
+                    stream_info = await stream_upstream.probe_metadata(video_id, stream_info)
+                except Exception as e:
+                    # Serve the original stream instead
+                    print(f"Transcode probe failed: {e}")
+            if stream_info.content_length and not transcoder.saturated():
+                if request.method == "GET" and new_playback:
+                    prewarm_scheduler.record_play(video_id)
+                return await transcoded_response(request, video_id, stream_info, kbps, started)
+
+        # 1. HEAD request: answered from the cached stream metadata, no upstream I/O
         if request.method == "HEAD":
-            async def get_head_response(url):
-                # We use GET stream because some YouTube formats don't support real HEAD
-                return await httpx_client.stream("GET", url, headers=headers, timeout=5)
-
-            try:
-                async with await get_head_response(audio_url) as r:
-                    target_response = r
-                    if r.status_code == 403:
-                        print(f"[{time.time()-start_time:.2f}s] HEAD 403. Re-extracting...")
-                        info = await yt_service.get_stream_url(video_id)
-                        if info and "url" in info:
-                            audio_url = info["url"]
-                            await redis_client.setex(f"stream:{video_id}", 3600, audio_url)
-                            # Open new connection for retry
-                            async with await get_head_response(audio_url) as r2:
-                                res_headers = {
-                                    "Accept-Ranges": "bytes",
-                                    "Content-Type": r2.headers.get("Content-Type", "audio/mpeg").split(";")[0].strip(),
-                                    "X-Accel-Buffering": "no",
-                                }
-                                if r2.headers.get("Content-Length"): res_headers["Content-Length"] = r2.headers.get("Content-Length")
-                                if r2.headers.get("Content-Range"): res_headers["Content-Range"] = r2.headers.get("Content-Range")
-                                return Response(status_code=r2.status_code, headers=res_headers)
-                    
-                    res_headers = {
-                        "Accept-Ranges": "bytes",
-                        "Content-Type": r.headers.get("Content-Type", "audio/mpeg").split(";")[0].strip(),
-                        "X-Accel-Buffering": "no",
-                    }
-                    if r.headers.get("Content-Length"): res_headers["Content-Length"] = r.headers.get("Content-Length")
-                    if r.headers.get("Content-Range"): res_headers["Content-Range"] = r.headers.get("Content-Range")
-                    return Response(status_code=r.status_code, headers=res_headers)
-            except Exception as e:
-                print(f"HEAD failed: {e}")
+            if not stream_info.content_length or not stream_info.mime_type:
+                try:
+                    stream_info = await stream_upstream.probe_metadata(video_id, stream_info)
+                except Exception as e:
+                    print(f"HEAD probe failed: {e}")
+            if not stream_info.content_length:
                 # Fallback to a plain 200 to keep the browser happy
-                return Response(status_code=200, headers={"Accept-Ranges": "bytes", "Content-Type": "audio/mpeg"})
+                return Response(status_code=200, headers={"Accept-Ranges": "bytes", "Content-Type": stream_info.mime_type or "audio/mpeg"})
 
-        # 2. GET request: Start streaming
-        req = httpx_client.build_request("GET", audio_url, headers=headers)
-        response = await httpx_client.send(req, stream=True)
+            try:
+                byte_range = parse_range(range_header, stream_info.content_length)
+            except RangeNotSatisfiable:
+                return Response(status_code=416, headers={"Content-Range": f"bytes */{stream_info.content_length}"})
+            ranged = byte_range is not None
+            start, end = byte_range or (0, stream_info.content_length - 1)
+            return Response(
+                status_code=206 if ranged else 200,
+                headers=stream_response_headers(stream_info, start, end, ranged)
+            )
+
+        if new_playback:
+            prewarm_scheduler.record_play(video_id)
+
+        # 2. GET request: serve through the disk segment cache when the total length is known
+        if stream_info.content_length:
+            total = stream_info.content_length
+            try:
+                byte_range = parse_range(range_header, total)
+            except RangeNotSatisfiable:
+                return Response(status_code=416, headers={"Content-Range": f"bytes */{total}"})
+            ranged = byte_range is not None
+            start, end = byte_range or (0, total - 1)
+            key = segment_cache.key(video_id, stream_info.itag, total)
+            # Concurrent listeners filling the same ranges share one upstream download,
+            # which resumes at the exact byte offset if the connection drops
+            fetch = stream_fanout.fetcher(key, stream_upstream.fetcher(video_id, stream_info))
+            prefix = stream_prefix.get(video_id, stream_info)
+            if prefix and start < len(prefix):
+                # Answer from the prefetched opening bytes; the pipeline reads ahead into
+                # the continuation while they are being sent
+                source = stream_prefix.splice(
+                    prefix, start, end, lambda offset: segment_cache.serve(key, offset, end, total, fetch))
+            else:
+                source = segment_cache.serve(key, start, end, total, fetch)
+            return AudioStreamResponse(
+                stream_pipeline.pipe(video_id, source, started),
+                status_code=206 if ranged else 200,
+                headers=stream_response_headers(stream_info, start, end, ranged),
+                media_type=stream_info.mime_type or "audio/mpeg"
+            )
+
+        # 3. Unknown length: plain proxy
+        headers = {"User-Agent": UPSTREAM_USER_AGENT}
+        if range_header:
+            headers["Range"] = range_header
+        req = http_pool.build_request("GET", stream_info.url, headers=headers)
+        response = await http_pool.send(req, stream=True)
         
         # Immediate retry on 403 (Expired)
         if response.status_code == 403:
             print(f"[{time.time()-start_time:.2f}s] Stream 403. Re-extracting...")
             await response.aclose()
-            info = await yt_service.get_stream_url(video_id)
-            if info and "url" in info:
-                audio_url = info["url"]
-                await redis_client.setex(f"stream:{video_id}", 3600, audio_url)
-                req = httpx_client.build_request("GET", audio_url, headers=headers)
-                response = await httpx_client.send(req, stream=True)
+            info = await stream_cache.extract(video_id)
+            if info:
+                stream_info = info
+                req = http_pool.build_request("GET", stream_info.url, headers=headers)
+                response = await http_pool.send(req, stream=True)
             else:
                 return JSONResponse(status_code=403, content={"error": "Source link expired"})
 
         print(f"[{time.time()-start_time:.2f}s] Stream connected: {response.status_code}")
 
+        # Remember mime/length so later HEADs and GETs don't need this path
+        if response.status_code in (200, 206) and capture_stream_metadata(stream_info, response):
+            await stream_cache.set(video_id, stream_info)
+
         # Normalization of MIME types to prevent NotSupportedError
         raw_content_type = response.headers.get("Content-Type", "audio/mpeg")
         base_content_type = raw_content_type.split(";")[0].strip()
@@ -293,20 +375,13 @@ async def stream_audio(request: Request, video_id: str):
 
         async def iter_content():
             try:
-                bytes_sent = 0
-                async for chunk in response.aiter_bytes(chunk_size=32 * 1024):
-                    if bytes_sent < 64 * 1024:
-                        # Deliver start instantly
-                        for i in range(0, len(chunk), 8 * 1024):
-                            yield chunk[i:i + 8 * 1024]
-                    else:
-                        yield chunk
-                    bytes_sent += len(chunk)
+                async for chunk in response.aiter_bytes():
+                    yield chunk
             finally:
                 await response.aclose()
 
-        return StreamingResponse(
-            iter_content(), 
+        return AudioStreamResponse(
+            stream_pipeline.pipe(video_id, iter_content(), started),
             status_code=response.status_code, 
             headers=res_headers,
             media_type=base_content_type
@@ -322,11 +397,13 @@ async def stream_audio(request: Request, video_id: str):
 @app.get("/recommend/user/{user_id}")
 async def recommend_user(user_id: str):
     recos = await recommendation_service.get_personalized_recommendations(user_id)
+    prewarm_results(recos, PRIORITY_RECOMMENDATION)
     return {"user_id": user_id, "recommendations": recos}
 
 @app.get("/recommend/song/{song_id}")
 async def recommend_song(song_id: str, user_id: str = "guest"):
     res = await recommendation_service.get_recent_context(user_id)
+    prewarm_results(res.get("recommendations", []), PRIORITY_RECOMMENDATION)
     return res
 
 @app.get("/recommend/trending")
@@ -337,13 +414,14 @@ async def trending():
 @app.get("/recommend/daily/{user_id}")
 async def daily_mix(user_id: str):
     recos = await recommendation_service.get_daily_mix(user_id)
+    prewarm_results(recos, PRIORITY_RECOMMENDATION)
     return {"user_id": user_id, "recommendations": recos}
 
 @app.get("/collections/{user_id}")
 async def collections(user_id: str):
     print(f"Fetching collections for {user_id}")
     try:
-        data = firebase_db.get_user_collections(user_id)
+        data = await firebase_db.get_user_collections(user_id)
         if data is None:
             return {"collections": {}}
         return {"collections": data}
@@ -351,11 +429,46 @@ async def collections(user_id: str):
         print(f"Error fetching collections: {e}")
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+@app.post("/history/record")
+async def record_history(request: Request):
+    """
+    Records a play in the user's history and their per-artist play counts.
+
+    Clients should record plays here instead of writing play_history directly:
+    plays written directly are missing from the artist counters, and cached
+    profiles only see them once they expire.
+    """
+    data = await request.json()
+    user_id, song = data.get("user_id"), data.get("song") or {}
+    if not user_id or not (song.get("video_id") or song.get("song_id")):
+        return JSONResponse(status_code=400, content={"error": "user_id and song.video_id are required"})
+    try:
+        await firebase_db.record_play(user_id, song)
+        await profile_cache.record_play(user_id, song)
+        return {"success": True}
+    except Exception as e:
+        print(f"Error recording play for {user_id}: {e}")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+@app.post("/profile/{user_id}/invalidate")
+async def invalidate_profile(request: Request, user_id: str):
+    """
+    Forces the user's cached taste profile to be rebuilt on its next read, e.g. right
+    after the client changed their likes. Takes the user's Firebase ID token as a
+    Bearer token.
+    """
+    authorization = request.headers.get("Authorization", "")
+    token = authorization[7:] if authorization.startswith("Bearer ") else None
+    if not token or await firebase_db.verify_id_token(token) != user_id:
+        return JSONResponse(status_code=401, content={"error": "Unauthorized"})
+    await profile_cache.invalidate(user_id)
+    return {"status": "invalidated"}
+
 # Device Management Endpoints
 @app.post("/devices/register")
 async def register_device(request: Request):
     data = await request.json()
-    success = device_manager.register_device(
+    success = await device_manager.register_device(
         data.get("user_id"), 
         data.get("device_id"), 
         data.get("device_info", {})
@@ -364,12 +477,12 @@ async def register_device(request: Request):
 
 @app.get("/devices/{user_id}")
 async def get_devices(user_id: str):
-    return {"devices": device_manager.get_user_devices(user_id)}
+    return {"devices": await device_manager.get_user_devices(user_id)}
 
 @app.post("/devices/active")
 async def set_active_device(request: Request):
     data = await request.json()
-    success = device_manager.set_active_device(data.get("user_id"), data.get("device_id"))
+    success = await device_manager.set_active_device(data.get("user_id"), data.get("device_id"))
     return {"success": success}
 
 @app.websocket("/ws")
@@ -387,7 +500,7 @@ async def websocket_endpoint(websocket: WebSocket):
         try:
             while True:
                 data = await websocket.receive_text()
-                req = json.loads(data)
+                req = loads_json(data)
                 
                 if req.get("type") == "auth":
                     user_id = req.get("user_id", "guest")
@@ -396,50 +509,70 @@ async def websocket_endpoint(websocket: WebSocket):
                 
                 elif req.get("type") == "ping":
                     if device_id:
-                        device_manager.update_device_heartbeat(user_id, device_id)
-                    await websocket.send_json({"type": "pong"})
+                        # Buffered; flushed to Firebase in batches
+                        device_manager.record_heartbeat(user_id, device_id)
+                    await websocket.send_text(dumps_text({"type": "pong"}))
 
                 elif req.get("type") == "search":
                     results = await search_service.search_songs(req.get("query"), user_id=user_id)
                     # Enrich with cached stream URLs
-                    for song in results:
-                        cached_url = await redis_client.get(f"stream:{song['id']}")
-                        if cached_url:
-                            song["stream_url"] = cached_url if isinstance(cached_url, str) else cached_url.decode('utf-8')
+                    await enrich_stream_urls(results)
                     
-                    await websocket.send_json({
+                    await websocket.send_text(dumps_text({
                         "type": "search_results", 
                         "query": req.get("query"), 
                         "results": results
-                    })
+                    }))
                     
-                    # Use asyncio task instead of BackgroundTasks (not natively supported in WS)
-                    if results:
-                        asyncio.create_task(prewarm_streams([results[0]["id"]]))
+                    # Queued on the shared scheduler; a newer search on this socket supersedes it
+                    prewarm_results(results, PRIORITY_SEARCH, group=f"ws:{id(websocket)}")
+                    prefetch_top_hits(results, group=f"ws:{id(websocket)}")
                 
                 elif req.get("type") == "autocomplete":
                     results = await search_service.search_songs(req.get("query"), limit=5, user_id=user_id)
-                    for song in results:
-                        cached_url = await redis_client.get(f"stream:{song['id']}")
-                        if cached_url:
-                            song["stream_url"] = cached_url if isinstance(cached_url, str) else cached_url.decode('utf-8')
+                    await enrich_stream_urls(results)
                             
-                    await websocket.send_json({
+                    await websocket.send_text(dumps_text({
                         "type": "suggestions", 
                         "query": req.get("query"), 
                         "results": results
-                    })
+                    }))
         except WebSocketDisconnect:
             logger.info(f"WebSocket disconnected normally from {client_host}")
         except Exception as e:
             logger.error(f"WebSocket error from {client_host}: {e}")
             import traceback
             traceback.print_exc()
+        finally:
+            if device_id:
+                device_manager.mark_offline(user_id, device_id)
     except Exception as e:
         logger.error(f"WebSocket accept failed from {client_host}: {e}")
         import traceback
         traceback.print_exc()
 
+@app.get("/debug/metrics")
+async def debug_metrics():
+    """Runtime counters for the in-process caches and coalescing layers."""
+    return {
+        "redis": redis_client.get_stats(),
+        "firebase": firebase_db.get_stats(),
+        "search": search_service.get_stats(),
+        "ydl_pool": ydl_pool.get_stats(),
+        "stream_cache": stream_cache.get_stats(),
+        "extraction": extraction_engine.get_stats(),
+        "prewarm": prewarm_scheduler.get_stats(),
+        "segment_cache": segment_cache.get_stats(),
+        "fanout": stream_fanout.get_stats(),
+        "upstream": stream_upstream.get_stats(),
+        "streams": stream_pipeline.get_stats(),
+        "prefix": stream_prefix.get_stats(),
+        "transcoder": transcoder.get_stats(),
+        "http_pool": http_pool.get_stats(),
+        "profile": profile_cache.get_stats(),
+        "devices": device_manager.get_stats(),
+    }
+
 @app.get("/debug/extract/{video_id}")
 async def debug_extract(video_id: str):
     """Debug endpoint to test raw yt-dlp extraction."""
@@ -450,10 +583,7 @@ async def debug_extract(video_id: str):
         
         # Return simplified info for debugging
         return {
-            "title": info.get("title"),
-            "url": info.get("url"),
-            "duration": info.get("duration"),
-            "formats_count": len(info.get("formats", [])),
+            **info.to_dict(),
             "cookies_used": yt_service.YDL_OPTS.get("cookiefile", "None")
         }
     except Exception as e:
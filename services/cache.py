@@ -0,0 +1,436 @@
+import redis.asyncio as redis
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+import asyncio
+import os
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# In-process tier in front of Redis for hot, read-mostly keys
+NEAR_CACHE_SIZE = int(os.getenv("REDIS_NEAR_CACHE_SIZE", "2048"))
+# Upper bound on local staleness should an invalidation ever be missed
+NEAR_CACHE_TTL = float(os.getenv("REDIS_NEAR_CACHE_TTL", "10"))
+NEAR_CACHE_PREFIXES = ("stream:", "ytsearch:")
+# Writers publish "{node_id}:{key}" here so other workers drop their local copy
+INVALIDATION_CHANNEL = "cache:invalidate"
+RESUBSCRIBE_DELAY = 5
+
+# Consecutive connection failures/timeouts that open the circuit
+BREAKER_THRESHOLD = int(os.getenv("REDIS_BREAKER_THRESHOLD", "3"))
+# Background probe interval while open, doubling up to the max
+BREAKER_PROBE_INTERVAL = 1.0
+BREAKER_MAX_PROBE_INTERVAL = 15.0
+BREAKER_PROBE_TIMEOUT = 1.0
+# Errors that mean Redis is unreachable or slow, as opposed to a bad command
+BREAKER_ERRORS = (RedisConnectionError, RedisTimeoutError, asyncio.TimeoutError, OSError)
+
+class CircuitBreaker:
+    """
+    closed: calls go through. open: calls fail fast without touching the network.
+    half_open: a background probe is checking whether Redis is back.
+    """
+
+    def __init__(self, threshold: int = BREAKER_THRESHOLD):
+        self.threshold = threshold
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.stats = {"trips": 0, "short_circuited": 0, "probes": 0, "recoveries": 0}
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        self.stats["short_circuited"] += 1
+        return False
+
+    def record_success(self):
+        self.failures = 0
+
+    def record_failure(self) -> bool:
+        """Returns True if this failure opened the circuit."""
+        self.failures += 1
+        if self.state == "closed" and self.failures >= self.threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.stats["trips"] += 1
+            return True
+        return False
+
+    def close(self):
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self.stats["recoveries"] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "open_for_s": round(time.monotonic() - self.opened_at, 1) if self.opened_at else None,
+        }
+
+class NearCache:
+    """Bounded TTL+LRU map of Redis values held by one process."""
+
+    def __init__(self, max_entries: int = NEAR_CACHE_SIZE, ttl: float = NEAR_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[Any, float]]" = OrderedDict()
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        value, expires_at = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[key]
+            return False, None
+        self._entries.move_to_end(key)
+        return True, value
+
+    def put(self, key: str, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def drop(self, key: str):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+class RedisBatch:
+    """Commands queued inside `async with redis_client.pipeline() as batch`, sent in one round trip on exit."""
+
+    def __init__(self, pipe):
+        self._pipe = pipe
+        self.results: List = []
+        self.written: List[str] = []
+
+    def get(self, key):
+        if self._pipe is not None:
+            self._pipe.get(key)
+        return self
+
+    def set(self, key, value, nx=False, px=None):
+        if self._pipe is not None:
+            self._pipe.set(key, value, nx=nx, px=px)
+            self.written.append(key)
+        return self
+
+    def setex(self, key, time, value):
+        if self._pipe is not None:
+            self._pipe.setex(key, time, value)
+            self.written.append(key)
+        return self
+
+    def delete(self, key):
+        if self._pipe is not None:
+            self._pipe.delete(key)
+            self.written.append(key)
+        return self
+
+# Safe Redis Wrapper
+class SafeRedis:
+    """
+    Redis client that logs and degrades instead of raising.
+
+    A circuit breaker trips after consecutive connection failures or timeouts;
+    while it is open every call returns its empty result immediately (the
+    service runs uncached) and a background probe closes it once Redis answers.
+
+    Reads of hot key families (NEAR_CACHE_PREFIXES) are served from a small
+    in-process near cache. Every write to such a key publishes an invalidation
+    in the same round trip, and each worker drops its copy when it sees one
+    from another worker. The near cache is only used while the invalidation
+    subscription is up. Other in-process caches built on Redis keys can
+    watch() a key prefix to hear about writes from other workers as well.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.client = None
+        self.node_id = uuid.uuid4().hex
+        self.near = NearCache()
+        self.breaker = CircuitBreaker()
+        self._prober: Optional[asyncio.Task] = None
+        self._subscribed = False
+        self._listener: Optional[asyncio.Task] = None
+        # (prefix, callback) pairs registered through watch()
+        self._watchers: List[Tuple[str, Callable[[Optional[str]], None]]] = []
+        # Bumped on every invalidation so a read that raced one doesn't repopulate stale data
+        self._generation = 0
+        self.stats = {"near_hits": 0, "near_misses": 0, "redis_hits": 0, "redis_misses": 0,
+                      "invalidations_sent": 0, "invalidations_received": 0, "near_resets": 0}
+        self._connect()
+
+    def _connect(self):
+        try:
+            self.client = redis.from_url(self.url, decode_responses=True, socket_timeout=5, socket_connect_timeout=5)
+            logger.info("Redis client initialized")
+        except Exception as e:
+            logger.error(f"Failed to initialize Redis client: {e}")
+            self.client = None
+
+    def _usable(self) -> bool:
+        return self.client is not None and self.breaker.allow()
+
+    def _failed(self, op: str, e: Exception):
+        logger.error(f"Redis {op} error: {e}")
+        if isinstance(e, BREAKER_ERRORS) and self.breaker.record_failure():
+            logger.warning(f"Redis circuit opened after {self.breaker.failures} consecutive failures")
+            self._prober = asyncio.create_task(self._probe())
+
+    async def _probe(self):
+        interval = BREAKER_PROBE_INTERVAL
+        while self.breaker.state != "closed":
+            await asyncio.sleep(interval)
+            self.breaker.state = "half_open"
+            self.breaker.stats["probes"] += 1
+            try:
+                await asyncio.wait_for(self.client.ping(), timeout=BREAKER_PROBE_TIMEOUT)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.breaker.state = "open"
+                interval = min(interval * 2, BREAKER_MAX_PROBE_INTERVAL)
+                continue
+            self.breaker.close()
+            logger.info("Redis circuit closed")
+
+    def _cacheable(self, key: str) -> bool:
+        return key.startswith(NEAR_CACHE_PREFIXES)
+
+    def _published(self, key: str) -> bool:
+        """Writes to these keys announce themselves on the invalidation channel."""
+        return self._cacheable(key) or any(key.startswith(prefix) for prefix, _ in self._watchers)
+
+    def watch(self, prefix: str, callback: Callable[[Optional[str]], None]):
+        """
+        Calls callback(key) when another worker writes or deletes a key under
+        prefix, and callback(None) when invalidations may have been missed.
+        Writes to such keys publish an invalidation, like near-cached ones.
+        """
+        self._watchers.append((prefix, callback))
+
+    def _notify(self, key: Optional[str]):
+        for prefix, callback in self._watchers:
+            if key is None or key.startswith(prefix):
+                try:
+                    callback(key)
+                except Exception as e:
+                    logger.error(f"Invalidation watcher for {prefix} failed: {e}")
+
+    def _count_remote(self, value):
+        if value is None:
+            self.stats["redis_misses"] += 1
+        else:
+            self.stats["redis_hits"] += 1
+
+    async def get(self, key):
+        near = self._subscribed and self._cacheable(key)
+        if near:
+            found, value = self.near.get(key)
+            if found:
+                self.stats["near_hits"] += 1
+                return value
+            self.stats["near_misses"] += 1
+            generation = self._generation
+        if not self._usable(): return None
+        try:
+            value = await self.client.get(key)
+        except Exception as e:
+            self._failed("GET", e)
+            return None
+        self.breaker.record_success()
+        self._count_remote(value)
+        if near and value is not None and generation == self._generation:
+            self.near.put(key, value)
+        return value
+
+    async def _write(self, key, queue):
+        """Runs one write command; for near-cached and watched keys the invalidation goes out in the same round trip."""
+        if not self._published(key):
+            return await queue(self.client)
+        pipe = self.client.pipeline(transaction=False)
+        queue(pipe)
+        pipe.publish(INVALIDATION_CHANNEL, f"{self.node_id}:{key}")
+        try:
+            result = (await pipe.execute())[0]
+        finally:
+            await pipe.reset()
+        self.stats["invalidations_sent"] += 1
+        self._generation += 1
+        self.near.drop(key)
+        return result
+
+    async def _run_write(self, op: str, key, queue, default):
+        if not self._usable(): return default
+        try:
+            result = await self._write(key, queue)
+        except Exception as e:
+            self._failed(op, e)
+            return default
+        self.breaker.record_success()
+        return result
+
+    async def set(self, key, value, nx=False, px=None):
+        return await self._run_write("SET", key, lambda c: c.set(key, value, nx=nx, px=px), False)
+
+    async def setex(self, key, time, value):
+        return await self._run_write("SETEX", key, lambda c: c.setex(key, time, value), False)
+
+    async def delete(self, key):
+        return await self._run_write("DELETE", key, lambda c: c.delete(key), 0)
+
+    async def mget(self, keys: Sequence[str]) -> List[Optional[str]]:
+        """Values for all keys in one round trip; None for missing keys (or all of them on error)."""
+        if not keys:
+            return []
+        values: List[Optional[str]] = [None] * len(keys)
+        remote = []
+        for i, key in enumerate(keys):
+            if self._subscribed and self._cacheable(key):
+                found, value = self.near.get(key)
+                if found:
+                    self.stats["near_hits"] += 1
+                    values[i] = value
+                    continue
+                self.stats["near_misses"] += 1
+            remote.append(i)
+        if not remote or not self._usable():
+            return values
+        generation = self._generation
+        try:
+            fetched = await self.client.mget([keys[i] for i in remote])
+        except Exception as e:
+            self._failed("MGET", e)
+            return values
+        self.breaker.record_success()
+        for i, value in zip(remote, fetched):
+            values[i] = value
+            self._count_remote(value)
+            if (value is not None and self._subscribed and self._cacheable(keys[i])
+                    and generation == self._generation):
+                self.near.put(keys[i], value)
+        return values
+
+    @asynccontextmanager
+    async def pipeline(self):
+        """
+        Batches commands into one round trip. Results are on batch.results after the block;
+        on error they are left empty.
+        """
+        batch = RedisBatch(self.client.pipeline(transaction=False) if self._usable() else None)
+        yield batch
+        if batch._pipe is None:
+            return
+        invalidated = [key for key in batch.written if self._published(key)]
+        for key in invalidated:
+            batch._pipe.publish(INVALIDATION_CHANNEL, f"{self.node_id}:{key}")
+        try:
+            results = await batch._pipe.execute()
+            batch.results = results[:len(results) - len(invalidated)]
+            self.stats["invalidations_sent"] += len(invalidated)
+            self.breaker.record_success()
+        except Exception as e:
+            self._failed("PIPELINE", e)
+        finally:
+            await batch._pipe.reset()
+            if invalidated:
+                self._generation += 1
+                for key in invalidated:
+                    self.near.drop(key)
+
+    async def msetex(self, mapping: Dict[str, str], time) -> bool:
+        """SETEX for several keys with the same TTL, in one round trip."""
+        if not mapping:
+            return True
+        async with self.pipeline() as batch:
+            for key, value in mapping.items():
+                batch.setex(key, time, value)
+        return bool(batch.results) and all(batch.results)
+
+    def _on_invalidation(self, data: str):
+        node_id, _, key = data.partition(":")
+        if node_id == self.node_id:
+            return
+        self.stats["invalidations_received"] += 1
+        self._generation += 1
+        self.near.drop(key)
+        self._notify(key)
+
+    async def _listen(self):
+        while True:
+            # Pub/sub connections idle for long stretches, so no socket timeout here
+            sub_client = redis.from_url(self.url, decode_responses=True, socket_connect_timeout=5,
+                                        health_check_interval=30)
+            pubsub = sub_client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                # Invalidations may have been missed while unsubscribed
+                self.near.clear()
+                self._notify(None)
+                self._subscribed = True
+                async for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        self._on_invalidation(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Redis invalidation subscription lost: {e}")
+            finally:
+                if self._subscribed:
+                    self.stats["near_resets"] += 1
+                    self._notify(None)
+                self._subscribed = False
+                self.near.clear()
+                try:
+                    await pubsub.close()
+                    await sub_client.close()
+                except Exception:
+                    pass
+            await asyncio.sleep(RESUBSCRIBE_DELAY)
+
+    def start(self):
+        if self.client and self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+
+    async def close(self):
+        for task in (self._listener, self._prober):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._listener = None
+        self._prober = None
+        if self.client:
+            await self.client.close()
+
+    def get_stats(self) -> Dict[str, Any]:
+        near_lookups = self.stats["near_hits"] + self.stats["near_misses"]
+        redis_lookups = self.stats["redis_hits"] + self.stats["redis_misses"]
+        return {
+            **self.stats,
+            "breaker": self.breaker.get_stats(),
+            "near_enabled": self._subscribed,
+            "near_entries": len(self.near),
+            "near_hit_ratio": round(self.stats["near_hits"] / near_lookups, 3) if near_lookups else None,
+            "redis_hit_ratio": round(self.stats["redis_hits"] / redis_lookups, 3) if redis_lookups else None,
+        }
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+redis_client = SafeRedis(REDIS_URL)
@@ -0,0 +1,94 @@
+import base64
+import json
+import os
+from typing import Any, Optional
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+try:
+    import msgpack
+    HAS_MSGPACK = True
+except ImportError:
+    HAS_MSGPACK = False
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+try:
+    import lz4.frame
+    HAS_LZ4 = True
+except ImportError:
+    HAS_LZ4 = False
+
+if HAS_ORJSON:
+    from fastapi.responses import ORJSONResponse as JSONResponse
+else:
+    from fastapi.responses import JSONResponse
+
+# Redis values written by RedisCodec start with this; anything else is a legacy JSON entry
+REDIS_CODEC_TAG = "~1"
+# zstd, lz4 or none; falls back to none if the library isn't installed
+REDIS_COMPRESSION = os.getenv("REDIS_COMPRESSION", "zstd")
+# Smaller payloads aren't worth compressing
+REDIS_COMPRESS_MIN_BYTES = 256
+
+def dumps_text(obj: Any) -> str:
+    """JSON text for HTTP/WS payloads, through orjson when available."""
+    if HAS_ORJSON:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(obj)
+
+def loads_json(data) -> Any:
+    if HAS_ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
+
+class RedisCodec:
+    """
+    Encodes cached values as msgpack, compressed with zstd or lz4 above a size
+    threshold. The shared Redis client decodes replies to str, so the binary
+    frame is base64-wrapped behind a version tag and a one-letter format code
+    (m: plain msgpack, z: zstd, l: lz4). Untagged values are legacy JSON and
+    still decode, so entries written before the switch stay readable.
+    """
+
+    def __init__(self, compression: str = REDIS_COMPRESSION):
+        if compression == "zstd" and HAS_ZSTD:
+            self.compression = "zstd"
+            self._zstd_c = zstandard.ZstdCompressor(level=3)
+            self._zstd_d = zstandard.ZstdDecompressor()
+        elif compression == "lz4" and HAS_LZ4:
+            self.compression = "lz4"
+        else:
+            self.compression = None
+
+    def encode(self, value: Any) -> str:
+        if not HAS_MSGPACK:
+            return dumps_text(value)
+        data = msgpack.packb(value, use_bin_type=True)
+        kind = "m"
+        if self.compression and len(data) >= REDIS_COMPRESS_MIN_BYTES:
+            if self.compression == "zstd":
+                data, kind = self._zstd_c.compress(data), "z"
+            else:
+                data, kind = lz4.frame.compress(data), "l"
+        return REDIS_CODEC_TAG + kind + base64.b64encode(data).decode("ascii")
+
+    def decode(self, raw: Optional[str]) -> Any:
+        if raw is None:
+            return None
+        if not raw.startswith(REDIS_CODEC_TAG):
+            return loads_json(raw)
+        kind = raw[len(REDIS_CODEC_TAG)]
+        data = base64.b64decode(raw[len(REDIS_CODEC_TAG) + 1:])
+        if kind == "z":
+            data = zstandard.ZstdDecompressor().decompress(data) if self.compression != "zstd" \
+                else self._zstd_d.decompress(data)
+        elif kind == "l":
+            data = lz4.frame.decompress(data)
+        return msgpack.unpackb(data, raw=False)
+
+redis_codec = RedisCodec()
@@ -1,14 +1,44 @@
+import asyncio
+import os
 import time
-from typing import Dict, Optional, List
+from typing import Any, Dict, Optional, List, Set, Tuple
+from services.cache import redis_client
 from services.firebase_db import firebase_db
-from firebase_admin import db
+
+# Seconds between flushes of buffered heartbeats to Firebase
+HEARTBEAT_FLUSH_INTERVAL = float(os.getenv("HEARTBEAT_FLUSH_INTERVAL", "15"))
+# The sweeper deletes devices not seen for this long (seconds)
+STALE_DEVICE_TTL = int(os.getenv("STALE_DEVICE_TTL", "86400"))
+DEVICE_SWEEP_INTERVAL = int(os.getenv("DEVICE_SWEEP_INTERVAL", "600"))
+# Users whose devices are read (and cleaned with one update) per sweep step
+DEVICE_SWEEP_BATCH = int(os.getenv("DEVICE_SWEEP_BATCH", "200"))
+# Held by the worker running a sweep, so only one of them scans per interval
+DEVICE_SWEEP_LEASE = "devices:sweep"
 
 class DeviceManager:
-    """Manages device registration, active device locking, and device lifecycle."""
+    """
+    Manages device registration, active device locking, and device lifecycle.
+
+    WebSocket heartbeats are recorded in a per-worker liveness table and
+    flushed every HEARTBEAT_FLUSH_INTERVAL seconds as one multi-path update,
+    together with online/offline transitions, instead of one write per ping.
+    A background sweeper removes devices unseen for STALE_DEVICE_TTL.
+    """
     
     DEVICE_TIMEOUT = 300  # 5 minutes in seconds
+
+    def __init__(self):
+        # (user_id, device_id) -> last heartbeat seen by this worker, epoch ms
+        self._seen: Dict[Tuple[str, str], float] = {}
+        # Heartbeats not yet written, and devices to mark offline on the next flush
+        self._dirty: Set[Tuple[str, str]] = set()
+        self._offline: Set[Tuple[str, str]] = set()
+        self._flusher: Optional[asyncio.Task] = None
+        self._sweeper: Optional[asyncio.Task] = None
+        self.stats = {"heartbeats": 0, "flushes": 0, "paths_written": 0, "flush_errors": 0,
+                      "sweeps": 0, "users_scanned": 0, "devices_removed": 0, "sweep_errors": 0}
     
-    def register_device(self, user_id: str, device_id: str, device_info: Dict) -> bool:
+    async def register_device(self, user_id: str, device_id: str, device_info: Dict) -> bool:
         """
         Register a device for a user.
         
@@ -19,28 +49,36 @@ class DeviceManager:
         """
         if not user_id or not device_id:
             return False
-            
+
+        device = {
+            'name': device_info.get('name', 'Unknown Device'),
+            'platform': device_info.get('platform', 'web'),
+            'userAgent': device_info.get('userAgent', ''),
+            'lastSeen': {'.sv': 'timestamp'},
+            'isOnline': True
+        }
+
         try:
-            ref = db.reference(f'users/{user_id}/devices/{device_id}')
-            ref.set({
-                'name': device_info.get('name', 'Unknown Device'),
-                'platform': device_info.get('platform', 'web'),
-                'userAgent': device_info.get('userAgent', ''),
-                'lastSeen': {'.sv': 'timestamp'},
-                'isOnline': True
-            })
-            
-            # If this is the first device, make it active
-            active_device = self.get_active_device(user_id)
-            if not active_device:
-                self.set_active_device(user_id, device_id)
-            
+            # The device exists before it can become active, so activeDeviceId never names a missing one
+            await firebase_db.write(f'users/{user_id}/devices/{device_id}', device)
+            # Liveness is tracked by the worker holding the device's WebSocket, not here
+            active = await firebase_db.read(f'users/{user_id}/playback/activeDeviceId')
+            if active and active != device_id and not await firebase_db.read(f'users/{user_id}/devices/{active}'):
+                # Removed without clearing the claim: as good as no active device
+                unclaimed = (None, active)
+            else:
+                unclaimed = (None,)
+            # If there is no active device (or it was removed), this one becomes active; the
+            # compare-and-set keeps a device another registration claimed meanwhile
+            await firebase_db.transaction(
+                f'users/{user_id}/playback/activeDeviceId',
+                lambda current: device_id if current in unclaimed else current)
             return True
         except Exception as e:
             print(f"Error registering device: {e}")
             return False
     
-    def set_active_device(self, user_id: str, device_id: str) -> bool:
+    async def set_active_device(self, user_id: str, device_id: str) -> bool:
         """
         Set the active playback device for a user.
         Only the active device can control playback.
@@ -50,58 +88,123 @@ class DeviceManager:
             
         try:
             # Verify device exists
-            device_ref = db.reference(f'users/{user_id}/devices/{device_id}')
-            device = device_ref.get()
+            device = await firebase_db.read(f'users/{user_id}/devices/{device_id}')
             
             if not device:
                 print(f"Device {device_id} not found for user {user_id}")
                 return False
             
             # Set as active
-            playback_ref = db.reference(f'users/{user_id}/playback')
-            playback_ref.update({'activeDeviceId': device_id})
+            await firebase_db.update(f'users/{user_id}/playback', {'activeDeviceId': device_id})
             
             return True
         except Exception as e:
             print(f"Error setting active device: {e}")
             return False
     
-    def get_active_device(self, user_id: str) -> Optional[str]:
+    async def get_active_device(self, user_id: str) -> Optional[str]:
         """Get the currently active device ID for a user."""
         if not user_id:
             return None
             
         try:
-            ref = db.reference(f'users/{user_id}/playback/activeDeviceId')
-            return ref.get()
+            return await firebase_db.read(f'users/{user_id}/playback/activeDeviceId')
         except Exception as e:
             print(f"Error getting active device: {e}")
             return None
     
-    def update_device_heartbeat(self, user_id: str, device_id: str) -> bool:
-        """Update device's last seen timestamp to keep it alive."""
+    def record_heartbeat(self, user_id: str, device_id: str) -> bool:
+        """Marks a device alive now; written to Firebase on the next flush."""
         if not user_id or not device_id:
             return False
-            
+        key = (user_id, device_id)
+        self._seen[key] = time.time() * 1000
+        self._dirty.add(key)
+        self._offline.discard(key)
+        self.stats["heartbeats"] += 1
+        return True
+
+    async def update_device_heartbeat(self, user_id: str, device_id: str) -> bool:
+        """Update device's last seen timestamp to keep it alive."""
+        return self.record_heartbeat(user_id, device_id)
+
+    def mark_offline(self, user_id: str, device_id: str):
+        """Records that a device's connection to this worker closed."""
+        if not user_id or not device_id:
+            return
+        key = (user_id, device_id)
+        self._dirty.discard(key)
+        self._offline.add(key)
+
+    async def flush_heartbeats(self) -> int:
+        """Writes buffered heartbeats and online/offline transitions as one multi-path update."""
+        now = time.time() * 1000
+        # Devices that stopped pinging this worker without a clean disconnect
+        for key, seen in list(self._seen.items()):
+            if now - seen > self.DEVICE_TIMEOUT * 1000 and key not in self._dirty:
+                self._offline.add(key)
+        for key in self._offline:
+            self._seen.pop(key, None)
+
+        dirty, offline = self._dirty, self._offline
+        self._dirty, self._offline = set(), set()
+        updates = {}
+        for user_id, device_id in dirty:
+            updates[f'users/{user_id}/devices/{device_id}/lastSeen'] = {'.sv': 'timestamp'}
+            updates[f'users/{user_id}/devices/{device_id}/isOnline'] = True
+        for user_id, device_id in offline:
+            updates[f'users/{user_id}/devices/{device_id}/isOnline'] = False
+        if not updates:
+            return 0
+
         try:
-            ref = db.reference(f'users/{user_id}/devices/{device_id}')
-            ref.update({
-                'lastSeen': {'.sv': 'timestamp'},
-                'isOnline': True
-            })
-            return True
+            await firebase_db.update('/', updates)
         except Exception as e:
-            print(f"Error updating heartbeat: {e}")
-            return False
+            # Keep them for the next flush; newer heartbeats take precedence over an offline mark
+            self._dirty |= dirty
+            self._offline |= offline - self._dirty
+            self.stats["flush_errors"] += 1
+            print(f"Error flushing device heartbeats: {e}")
+            return 0
+        self.stats["flushes"] += 1
+        self.stats["paths_written"] += len(updates)
+        return len(updates)
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_FLUSH_INTERVAL)
+            await self.flush_heartbeats()
+
+    def start(self):
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self.flush_loop())
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self.sweep_loop())
+
+    async def stop(self):
+        for task in (self._flusher, self._sweeper):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._flusher = self._sweeper = None
+        # Connections are going away with this worker
+        for user_id, device_id in list(self._seen):
+            self.mark_offline(user_id, device_id)
+        await self.flush_heartbeats()
+
+    def get_stats(self) -> Dict:
+        return {**self.stats, "tracked": len(self._seen), "pending": len(self._dirty) + len(self._offline)}
     
-    def get_user_devices(self, user_id: str) -> List[Dict]:
+    async def get_user_devices(self, user_id: str) -> List[Dict]:
         """Get all devices for a user with online status."""
         if not user_id:
             return []
             
         try:
-            ref = db.reference(f'users/{user_id}/devices')
-            devices_data = ref.get()
+            devices_data = await firebase_db.read(f'users/{user_id}/devices')
             
             if not devices_data:
                 return []
@@ -110,7 +213,8 @@ class DeviceManager:
             current_time = time.time() * 1000  # Convert to milliseconds
             
             for device_id, device_info in devices_data.items():
-                last_seen = device_info.get('lastSeen', 0)
+                # A heartbeat this worker hasn't flushed yet is newer than what Firebase has
+                last_seen = max(device_info.get('lastSeen', 0), self._seen.get((user_id, device_id), 0))
                 is_online = (current_time - last_seen) < (self.DEVICE_TIMEOUT * 1000)
                 
                 devices.append({
@@ -126,34 +230,79 @@ class DeviceManager:
             print(f"Error getting user devices: {e}")
             return []
     
-    def cleanup_stale_devices(self, user_id: str) -> int:
+    async def _stale_paths(self, user_id: str, devices: Any, max_age: float, now: float) -> Dict[str, None]:
+        """Multi-path deletes for the user's devices unseen for max_age seconds."""
+        if not isinstance(devices, dict):
+            return {}
+        paths = {}
+        for device_id, device_info in devices.items():
+            last_seen = max((device_info or {}).get('lastSeen', 0) or 0, self._seen.get((user_id, device_id), 0))
+            if now - last_seen > max_age * 1000:
+                paths[f'users/{user_id}/devices/{device_id}'] = None
+        if paths:
+            active = await firebase_db.read(f'users/{user_id}/playback/activeDeviceId')
+            if active and f'users/{user_id}/devices/{active}' in paths:
+                paths[f'users/{user_id}/playback/activeDeviceId'] = None
+        return paths
+
+    async def cleanup_stale_devices(self, user_id: str) -> int:
         """Remove devices that haven't been seen in >5 minutes."""
         if not user_id:
             return 0
             
         try:
-            ref = db.reference(f'users/{user_id}/devices')
-            devices_data = ref.get()
-            
-            if not devices_data:
-                return 0
-            
-            current_time = time.time() * 1000
-            removed_count = 0
-            
-            for device_id, device_info in devices_data.items():
-                last_seen = device_info.get('lastSeen', 0)
-                if (current_time - last_seen) > (self.DEVICE_TIMEOUT * 1000):
-                    device_ref = db.reference(f'users/{user_id}/devices/{device_id}')
-                    device_ref.delete()
-                    removed_count += 1
-            
-            return removed_count
+            devices = await firebase_db.read(f'users/{user_id}/devices')
+            paths = await self._stale_paths(user_id, devices, self.DEVICE_TIMEOUT, time.time() * 1000)
+            if paths:
+                await firebase_db.update('/', paths)
+            return sum(1 for p in paths if '/devices/' in p)
         except Exception as e:
             print(f"Error cleaning up devices: {e}")
             return 0
+
+    async def sweep_stale_devices(self, max_age: float = STALE_DEVICE_TTL) -> int:
+        """
+        Lists user ids with a shallow read, then reads only the devices of each
+        batch of DEVICE_SWEEP_BATCH users (concurrently) and deletes their stale
+        devices with one multi-location update per batch.
+        """
+        removed = 0
+        user_ids = sorted(await firebase_db.read_keys('users'))
+        for i in range(0, len(user_ids), DEVICE_SWEEP_BATCH):
+            batch = user_ids[i:i + DEVICE_SWEEP_BATCH]
+            devices = await asyncio.gather(
+                *(firebase_db.read(f'users/{user_id}/devices') for user_id in batch), return_exceptions=True)
+            now = time.time() * 1000
+            paths = {}
+            for user_id, user_devices in zip(batch, devices):
+                if isinstance(user_devices, Exception):
+                    print(f"Device sweep skipped {user_id}: {user_devices}")
+                    continue
+                paths.update(await self._stale_paths(user_id, user_devices, max_age, now))
+            if paths:
+                await firebase_db.update('/', paths)
+                removed += sum(1 for p in paths if '/devices/' in p)
+            self.stats["users_scanned"] += len(batch)
+        self.stats["devices_removed"] += removed
+        return removed
+
+    async def sweep_loop(self):
+        while True:
+            await asyncio.sleep(DEVICE_SWEEP_INTERVAL)
+            try:
+                # One worker sweeps per interval; the others skip
+                if not await redis_client.set(DEVICE_SWEEP_LEASE, redis_client.node_id, nx=True,
+                                              px=DEVICE_SWEEP_INTERVAL * 1000):
+                    continue
+                self.stats["sweeps"] += 1
+                removed = await self.sweep_stale_devices()
+                if removed:
+                    print(f"Device sweep removed {removed} stale devices")
+            except Exception as e:
+                self.stats["sweep_errors"] += 1
+                print(f"Device sweep failed: {e}")
     
-    def validate_device_control(self, user_id: str, device_id: str) -> bool:
+    async def validate_device_control(self, user_id: str, device_id: str) -> bool:
         """
         Check if a device is allowed to control playback.
         Returns True only if device_id matches activeDeviceId.
@@ -161,7 +310,7 @@ class DeviceManager:
         if not user_id or not device_id:
             return False
             
-        active_device = self.get_active_device(user_id)
+        active_device = await self.get_active_device(user_id)
         return device_id == active_device
 
 device_manager = DeviceManager()
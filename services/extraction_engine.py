@@ -0,0 +1,248 @@
+import asyncio
+import itertools
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+# Worker processes per web worker, spawned on first use
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", "1"))
+EXTRACTION_TIMEOUT = float(os.getenv("EXTRACTION_TIMEOUT", "45"))
+# A process idle this long (seconds) exits; the next job spawns a fresh one
+EXTRACTION_IDLE_TIMEOUT = float(os.getenv("EXTRACTION_IDLE_TIMEOUT", "120"))
+# Memory for all extraction processes of the instance, shared out across web
+# workers (WEB_CONCURRENCY, as uvicorn reads it) and their processes
+EXTRACTION_MEMORY_BUDGET_MB = int(os.getenv("EXTRACTION_MEMORY_BUDGET_MB", "400"))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "4"))
+# A worker above this RSS is killed (mid-task) or recycled (after a task)
+EXTRACTION_MAX_RSS_MB = int(os.getenv(
+    "EXTRACTION_MAX_RSS_MB", str(EXTRACTION_MEMORY_BUDGET_MB // (WEB_CONCURRENCY * EXTRACTION_WORKERS))))
+# Recycle a worker after this many tasks to release fragmented memory
+EXTRACTION_MAX_TASKS = int(os.getenv("EXTRACTION_MAX_TASKS", "50"))
+
+# Lower runs first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_REFRESH = 5
+PRIORITY_PREWARM = 10
+
+WATCHDOG_INTERVAL = 0.5
+
+def _rss_bytes(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def _worker_main(conn):
+    """Entry point of an extraction process: receives video ids, sends back results."""
+    # Heavy imports only ever happen in the child
+    from services.youtube import yt_service
+    from services.ydl_pool import ydl_pool
+    ydl_pool.warm(["audio"], limit=1)
+
+    while True:
+        try:
+            video_id = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if video_id is None:
+            break
+        try:
+            conn.send(("ok", yt_service.extract_blocking(video_id)))
+        except Exception as e:
+            conn.send(("error", str(e)))
+
+class _Worker:
+    """One extraction process and its pipe. Only ever driven by one thread at a time."""
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.process = None
+        self.conn = None
+        self.tasks = 0
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def start(self):
+        parent_conn, child_conn = self.ctx.Pipe()
+        self.process = self.ctx.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self.tasks = 0
+
+    def stop(self, kill: bool = False):
+        if self.process is None:
+            return
+        try:
+            if not kill and self.alive():
+                self.conn.send(None)
+                self.process.join(timeout=2)
+        except Exception:
+            pass
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join(timeout=2)
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+        self.process = None
+        self.conn = None
+
+    def rss(self) -> int:
+        return _rss_bytes(self.process.pid) if self.process else 0
+
+    def run(self, video_id: str, timeout: float, max_rss: int):
+        """Blocking: runs one extraction, enforcing the timeout and the RSS limit."""
+        if not self.alive():
+            self.start()
+        deadline = time.monotonic() + timeout
+        try:
+            self.conn.send(video_id)
+            while not self.conn.poll(WATCHDOG_INTERVAL):
+                if not self.alive():
+                    raise EOFError
+                if time.monotonic() > deadline:
+                    self.stop(kill=True)
+                    raise TimeoutError(f"extraction of {video_id} timed out after {timeout:.0f}s")
+                if self.rss() > max_rss:
+                    self.stop(kill=True)
+                    raise MemoryError(f"extraction worker exceeded {max_rss // (1024 * 1024)} MB")
+            status, payload = self.conn.recv()
+        except (EOFError, ConnectionError):
+            self.stop(kill=True)
+            raise RuntimeError("extraction worker died")
+        self.tasks += 1
+        if status != "ok":
+            raise RuntimeError(payload)
+        return payload
+
+class ExtractionEngine:
+    """
+    Runs yt-dlp extractions in a bounded pool of worker processes, keeping their
+    memory and GIL contention out of the web workers.
+
+    Jobs go through a priority queue so interactive /stream requests are served
+    before refresh and prewarm work, and concurrent jobs for the same video share
+    one extraction. Processes are spawned when a job needs them and exit after
+    EXTRACTION_IDLE_TIMEOUT without work, so an idle web worker holds none.
+    """
+
+    def __init__(self, workers: int = EXTRACTION_WORKERS, timeout: float = EXTRACTION_TIMEOUT,
+                 max_rss_mb: int = EXTRACTION_MAX_RSS_MB, max_tasks: int = EXTRACTION_MAX_TASKS):
+        self.workers = workers
+        self.timeout = timeout
+        self.max_rss = max_rss_mb * 1024 * 1024
+        self.max_tasks = max_tasks
+        self._ctx = multiprocessing.get_context("spawn")
+        self._workers: List[_Worker] = []
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._threads: Optional[ThreadPoolExecutor] = None
+        self._dispatchers: List[asyncio.Task] = []
+        # video_id -> [future, best priority queued so far, started]
+        self._pending: Dict[str, List[Any]] = {}
+        self._seq = itertools.count()
+        self.running = False
+        self.stats = {"submitted": 0, "coalesced": 0, "completed": 0, "failed": 0,
+                      "timeouts": 0, "rss_kills": 0, "recycled": 0, "reaped": 0}
+
+    async def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._threads = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="extract")
+        # Processes are spawned by the first job each worker runs
+        self._workers = [_Worker(self._ctx) for _ in range(self.workers)]
+        self._dispatchers = [asyncio.create_task(self._dispatch(w)) for w in self._workers]
+        self.running = True
+
+    async def stop(self):
+        self.running = False
+        for task in self._dispatchers:
+            task.cancel()
+        await asyncio.gather(*self._dispatchers, return_exceptions=True)
+        self._dispatchers = []
+        for fut, _, _ in self._pending.values():
+            if not fut.done():
+                fut.cancel()
+        self._pending.clear()
+        for w in self._workers:
+            w.stop()
+        if self._threads:
+            self._threads.shutdown(wait=False)
+            self._threads = None
+
+    async def submit(self, video_id: str, priority: int = PRIORITY_INTERACTIVE):
+        self.stats["submitted"] += 1
+        pending = self._pending.get(video_id)
+        if pending is not None:
+            self.stats["coalesced"] += 1
+            fut, queued_priority, started = pending
+            if priority < queued_priority and not started:
+                # Re-queue at the more urgent priority; whichever copy runs first wins
+                pending[1] = priority
+                self._queue.put_nowait((priority, next(self._seq), video_id))
+            return await asyncio.shield(fut)
+
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[video_id] = [fut, priority, False]
+        self._queue.put_nowait((priority, next(self._seq), video_id))
+        return await asyncio.shield(fut)
+
+    async def _dispatch(self, worker: _Worker):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                _, _, video_id = await asyncio.wait_for(self._queue.get(), EXTRACTION_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                if worker.alive():
+                    self.stats["reaped"] += 1
+                    await loop.run_in_executor(self._threads, worker.stop)
+                continue
+            pending = self._pending.get(video_id)
+            if pending is None or pending[2]:
+                # Already handled through a duplicate, higher-priority entry
+                continue
+            pending[2] = True
+            fut = pending[0]
+            try:
+                result = await loop.run_in_executor(self._threads, worker.run, video_id, self.timeout, self.max_rss)
+                self.stats["completed"] += 1
+                if not fut.done():
+                    fut.set_result(result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats["failed"] += 1
+                if isinstance(e, TimeoutError):
+                    self.stats["timeouts"] += 1
+                elif isinstance(e, MemoryError):
+                    self.stats["rss_kills"] += 1
+                if not fut.done():
+                    fut.set_exception(e)
+                    # Retrieved by callers; avoid "never retrieved" noise if they went away
+                    fut.exception()
+            finally:
+                if self._pending.get(video_id) is pending:
+                    del self._pending[video_id]
+
+            if worker.alive() and (worker.tasks >= self.max_tasks or worker.rss() > self.max_rss):
+                self.stats["recycled"] += 1
+                await loop.run_in_executor(self._threads, worker.stop)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "running": self.running,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "workers": [
+                {"alive": w.alive(), "tasks": w.tasks, "rss_mb": round(w.rss() / (1024 * 1024), 1)}
+                for w in self._workers
+            ],
+        }
+
+extraction_engine = ExtractionEngine()
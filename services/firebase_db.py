@@ -1,16 +1,36 @@
 import firebase_admin
-from firebase_admin import credentials, db
+from firebase_admin import auth, credentials, db, exceptions
 import os
+import re
 import json
 import base64
+import asyncio
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
 
 # Use the database URL provided by the user in their config
 FIREBASE_DB_URL = os.getenv("FIREBASE_DB_URL", "https://music-app-f2e65-default-rtdb.asia-southeast1.firebasedatabase.app")
 SERVICE_ACCOUNT_FILE = "serviceAccountKey.json"
+# Realtime Database calls are blocking HTTP; at most this many run at once per worker
+FIREBASE_WORKERS = int(os.getenv("FIREBASE_WORKERS", "8"))
+# Seconds before a call is abandoned (also passed to the SDK's own HTTP timeout)
+FIREBASE_TIMEOUT = float(os.getenv("FIREBASE_TIMEOUT", "5"))
+# Characters Realtime Database keys may not contain
+UNSAFE_KEY_CHARS = re.compile(r'[.#$\[\]/\x00-\x1f\x7f]')
 
 class FirebaseDB:
+    """
+    Async access to the Realtime Database. The admin SDK is synchronous, so every
+    call runs on a dedicated bounded thread pool with a timeout and never on the
+    event loop; independent reads can be awaited concurrently.
+    """
+
     def __init__(self):
         self.app = None
+        self._executor = ThreadPoolExecutor(max_workers=FIREBASE_WORKERS, thread_name_prefix="firebase")
+        self.stats = {"calls": 0, "timeouts": 0, "errors": 0, "unindexed_queries": 0}
         self._init_firebase()
 
     def _init_firebase(self):
@@ -23,7 +43,8 @@ class FirebaseDB:
                     cred_dict = json.loads(decoded)
                     cred = credentials.Certificate(cred_dict)
                     self.app = firebase_admin.initialize_app(cred, {
-                        "databaseURL": FIREBASE_DB_URL
+                        "databaseURL": FIREBASE_DB_URL,
+                        "httpTimeout": FIREBASE_TIMEOUT
                     })
                     print("Firebase initialized via Environment Variable.")
                     return
@@ -38,7 +59,8 @@ class FirebaseDB:
                 try:
                     cred = credentials.Certificate(cert_path)
                     self.app = firebase_admin.initialize_app(cred, {
-                        "databaseURL": FIREBASE_DB_URL
+                        "databaseURL": FIREBASE_DB_URL,
+                        "httpTimeout": FIREBASE_TIMEOUT
                     })
                     print("Firebase initialized via Local File.")
                 except Exception as e:
@@ -46,9 +68,69 @@ class FirebaseDB:
             else:
                 print(f"Warning: Firebase credentials not found. DB operations will fail gracefully.")
 
-    def get_play_history(self, user_id, limit=50):
-        ref = db.reference(f"play_history/{user_id}")
-        data = ref.get()
+    async def run(self, fn: Callable, *args, timeout: float = FIREBASE_TIMEOUT) -> Any:
+        """Runs a blocking SDK call on the Firebase pool."""
+        self.stats["calls"] += 1
+        loop = asyncio.get_running_loop()
+        try:
+            return await asyncio.wait_for(loop.run_in_executor(self._executor, fn, *args), timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            raise
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+
+    async def verify_id_token(self, id_token: str) -> Optional[str]:
+        """The uid a Firebase Auth ID token was issued to, or None if it doesn't verify."""
+        try:
+            return (await self.run(lambda: auth.verify_id_token(id_token, app=self.app)))["uid"]
+        except Exception as e:
+            print(f"ID token rejected: {e}")
+            return None
+
+    async def read(self, path: str) -> Any:
+        return await self.run(lambda: db.reference(path).get())
+
+    async def write(self, path: str, value: Any):
+        return await self.run(lambda: db.reference(path).set(value))
+
+    async def update(self, path: str, value: Dict[str, Any]):
+        return await self.run(lambda: db.reference(path).update(value))
+
+    async def delete(self, path: str):
+        return await self.run(lambda: db.reference(path).delete())
+
+    async def query_last(self, path: str, child: str, limit: int) -> Any:
+        """
+        The limit entries of path with the highest child value, selected by the
+        server. Needs an ".indexOn" for child (see docs/firebase-indexes.md); without
+        one the server rejects the query and the whole node is read instead.
+        """
+        try:
+            return await self.run(lambda: db.reference(path).order_by_child(child).limit_to_last(limit).get())
+        except exceptions.FirebaseError as e:
+            self.stats["unindexed_queries"] += 1
+            print(f"Indexed query on {path} by {child} failed, reading it whole: {e}")
+            return await self.read(path)
+
+    async def read_keys(self, path: str) -> List[str]:
+        """The child keys of path, without their values (a shallow read)."""
+        data = await self.run(lambda: db.reference(path).get(shallow=True))
+        return list(data) if isinstance(data, dict) else []
+
+    async def transaction(self, path: str, update: Callable[[Any], Any]) -> Any:
+        """
+        Atomically replaces the value at path with update(current). The SDK reads
+        the node with its ETag and writes conditionally, retrying on conflicts.
+        """
+        return await self.run(lambda: db.reference(path).transaction(update))
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "workers": FIREBASE_WORKERS}
+
+    async def get_play_history(self, user_id, limit=50):
+        data = await self.query_last(f"play_history/{user_id}", "timestamp", limit)
         if not data: return []
         
         # In current setup, it's a list of song IDs or objects
@@ -63,11 +145,41 @@ class FirebaseDB:
                     songs.append({"video_id": str(item)})
         return songs[-limit:]
 
-    def get_frequent_artists(self, user_id, limit=10):
-        # Implementation of frequent artist logic
-        # For now, we simulate this as it might require a complex query or post-processing
-        history = self.get_play_history(user_id, limit=100)
-        artists = {}
+    @staticmethod
+    def artist_key(artist: str) -> str:
+        return UNSAFE_KEY_CHARS.sub("_", artist.strip().lower())[:200]
+
+    async def record_play(self, user_id: str, song: Dict[str, Any]):
+        """
+        Appends a play to the user's history and bumps their per-artist play
+        counter, as one multi-path update. The counter uses a server-side
+        increment, so concurrent plays from several devices all count.
+        """
+        play = {k: song[k] for k in ("song_id", "video_id", "title", "artist") if song.get(k)}
+        play["timestamp"] = {".sv": "timestamp"}
+        # Time-ordered, unique key; reads order by the timestamp child regardless
+        key = f"{int(time.time() * 1000):013d}-{uuid.uuid4().hex[:8]}"
+        updates = {f"play_history/{user_id}/{key}": play}
+        artist = (song.get("artist") or "").strip()
+        if artist:
+            counter = f"artist_plays/{user_id}/{self.artist_key(artist)}"
+            updates[f"{counter}/name"] = artist
+            updates[f"{counter}/plays"] = {".sv": {"increment": 1}}
+        await self.update("/", updates)
+
+    async def get_artist_plays(self, user_id, limit=30) -> Dict[str, int]:
+        """The user's limit most played artists with their play counts, from the record_play counters."""
+        counters = await self.query_last(f"artist_plays/{user_id}", "plays", limit)
+        if not isinstance(counters, dict):
+            return {}
+        return {c["name"]: c.get("plays", 0) for c in counters.values() if isinstance(c, dict) and c.get("name")}
+
+    async def get_frequent_artists(self, user_id, limit=10):
+        # The counters only hold plays recorded through POST /history/record, so they are
+        # added to the counts over recent history rather than replacing them
+        plays, history = await asyncio.gather(
+            self.get_artist_plays(user_id, limit), self.get_play_history(user_id, limit=100))
+        artists = dict(plays)
         for h in history:
             artist = h.get('artist')
             if artist:
@@ -76,23 +188,20 @@ class FirebaseDB:
         sorted_artists = sorted(artists.items(), key=lambda x: x[1], reverse=True)
         return [a[0] for a in sorted_artists[:limit]]
 
-    def get_liked_songs(self, user_id):
-        ref = db.reference(f"likes/{user_id}")
-        data = ref.get()
+    async def get_liked_songs(self, user_id):
+        data = await self.read(f"likes/{user_id}")
         if not data: return []
         if isinstance(data, dict):
             return list(data.values())
         return data
 
-    def get_song_metadata(self, song_id: str):
-        ref = db.reference(f"songs/{song_id}")
-        data = ref.get()
+    async def get_song_metadata(self, song_id: str):
+        data = await self.read(f"songs/{song_id}")
         return data if data else {}
 
-    def get_user_collections(self, user_id: str):
+    async def get_user_collections(self, user_id: str):
         try:
-            ref = db.reference(f"collections/{user_id}")
-            data = ref.get()
+            data = await self.read(f"collections/{user_id}")
             return data if data else {}
         except Exception as e:
             print(f"Error fetching collections for {user_id}: {e}")
@@ -0,0 +1,231 @@
+import asyncio
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional
+import httpx
+try:
+    import h2  # noqa: F401  (httpx only negotiates HTTP/2 when h2 is installed)
+    HAS_HTTP2 = True
+except ImportError:
+    HAS_HTTP2 = False
+
+HTTP_TIMEOUT = httpx.Timeout(10.0, connect=5.0)
+# Bounds for a host's connection pool; it is sized between them from observed concurrency
+HTTP_POOL_INITIAL_CONNECTIONS = 20
+HTTP_POOL_MIN_CONNECTIONS = 4
+HTTP_POOL_MAX_CONNECTIONS = int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", "50"))
+# Pool size relative to the peak number of concurrent requests seen in the last interval
+HTTP_POOL_HEADROOM = 1.5
+HTTP_POOL_RESIZE_INTERVAL = 60
+# A resize only happens when the target differs from the current size by this fraction
+HTTP_POOL_RESIZE_THRESHOLD = 0.25
+# Host pools without traffic for this long are closed
+HTTP_POOL_IDLE_TTL = 300
+
+class _CountedStream(httpx.AsyncByteStream):
+    """Response body wrapper that reports when the response is closed."""
+
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        if self._on_close is not None:
+            self._on_close()
+            self._on_close = None
+        await self._stream.aclose()
+
+class _HostPool:
+    """One host's client, plus the request and connection counters used to size it."""
+
+    def __init__(self, host: str, size: int):
+        self.host = host
+        self.size = size
+        self.in_flight = 0
+        self.peak = 0
+        self.last_used = time.monotonic()
+        self.transport = _TrackedTransport(self, size)
+        self.client = _new_client(self.transport)
+        self.stats = {"requests": 0, "saturated": 0, "connects": 0, "connect_ms_total": 0.0,
+                      "wait_ms_total": 0.0, "wait_ms_max": 0.0, "resizes": 0}
+
+    def get_stats(self) -> Dict[str, Any]:
+        connects = self.stats["connects"]
+        requests = self.stats["requests"]
+        return {
+            **self.stats,
+            "size": self.size,
+            "in_flight": self.in_flight,
+            "peak": self.peak,
+            "connect_ms_avg": round(self.stats["connect_ms_total"] / connects, 1) if connects else None,
+            "wait_ms_avg": round(self.stats["wait_ms_total"] / requests, 1) if requests else None,
+        }
+
+class _TrackedTransport(httpx.AsyncBaseTransport):
+    """Counts in-flight requests per client and times connects and pool waits via httpcore's trace hook."""
+
+    def __init__(self, pool: _HostPool, size: int):
+        self.pool = pool
+        self.in_flight = 0
+        self._transport = httpx.AsyncHTTPTransport(
+            http2=HAS_HTTP2,
+            limits=httpx.Limits(max_connections=size, max_keepalive_connections=size),
+        )
+
+    def _done(self):
+        self.in_flight -= 1
+        self.pool.in_flight -= 1
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        pool = self.pool
+        pool.stats["requests"] += 1
+        pool.last_used = time.monotonic()
+        if pool.in_flight >= pool.size:
+            # Every connection is busy (or every stream slot, over HTTP/1.1): this request queues
+            pool.stats["saturated"] += 1
+        self.in_flight += 1
+        pool.in_flight += 1
+        pool.peak = max(pool.peak, pool.in_flight)
+
+        started = time.monotonic()
+        marks = {}
+        outer_trace = request.extensions.get("trace")
+
+        async def trace(event: str, info: Dict):
+            marks.setdefault(event, time.monotonic())
+            if event.endswith("send_request_headers.started"):
+                connect = 0.0
+                if "connection.connect_tcp.started" in marks:
+                    connect_end = marks.get("connection.start_tls.complete") or marks.get(
+                        "connection.connect_tcp.complete", marks["connection.connect_tcp.started"])
+                    connect = (connect_end - marks["connection.connect_tcp.started"]) * 1000
+                    pool.stats["connects"] += 1
+                    pool.stats["connect_ms_total"] += connect
+                wait = max(0.0, (marks[event] - started) * 1000 - connect)
+                pool.stats["wait_ms_total"] += wait
+                pool.stats["wait_ms_max"] = max(pool.stats["wait_ms_max"], wait)
+            if outer_trace is not None:
+                await outer_trace(event, info)
+
+        request.extensions["trace"] = trace
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            self._done()
+            raise
+        response.stream = _CountedStream(response.stream, self._done)
+        return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+def _new_client(transport: _TrackedTransport) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        transport=transport,
+        timeout=HTTP_TIMEOUT,
+        follow_redirects=True,
+    )
+
+class HTTPPoolManager:
+    """
+    Outbound HTTP for the service: one client per host, negotiating HTTP/2 where
+    the server (and the installed h2 package) allow it, so concurrent streams
+    from the same googlevideo host multiplex over a connection.
+
+    Each host's pool is resized in the background from the peak concurrency seen
+    since the last check. A replaced client keeps serving its in-flight responses
+    and is closed once they finish.
+
+    Exposes the subset of the httpx.AsyncClient API the service uses.
+    """
+
+    def __init__(self):
+        self._pools: Dict[str, _HostPool] = {}
+        # Replaced clients still serving responses, with their transports
+        self._retiring: List[tuple] = []
+        self._resizer: Optional[asyncio.Task] = None
+        self.http2 = HAS_HTTP2
+
+    def _pool(self, url) -> _HostPool:
+        host = httpx.URL(url).host
+        pool = self._pools.get(host)
+        if pool is None:
+            pool = self._pools[host] = _HostPool(host, HTTP_POOL_INITIAL_CONNECTIONS)
+        return pool
+
+    def build_request(self, method: str, url, **kwargs) -> httpx.Request:
+        return self._pool(url).client.build_request(method, url, **kwargs)
+
+    async def send(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        return await self._pool(request.url).client.send(request, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method: str, url, **kwargs):
+        async with self._pool(url).client.stream(method, url, **kwargs) as response:
+            yield response
+
+    def _target_size(self, pool: _HostPool) -> int:
+        target = math.ceil(pool.peak * HTTP_POOL_HEADROOM)
+        return max(HTTP_POOL_MIN_CONNECTIONS, min(HTTP_POOL_MAX_CONNECTIONS, target))
+
+    async def _resize(self):
+        now = time.monotonic()
+        for host, pool in list(self._pools.items()):
+            if pool.in_flight == 0 and now - pool.last_used > HTTP_POOL_IDLE_TTL:
+                del self._pools[host]
+                await pool.client.aclose()
+                continue
+            target = self._target_size(pool)
+            if abs(target - pool.size) >= pool.size * HTTP_POOL_RESIZE_THRESHOLD:
+                self._retiring.append((pool.client, pool.transport))
+                pool.transport = _TrackedTransport(pool, target)
+                pool.client = _new_client(pool.transport)
+                pool.size = target
+                pool.stats["resizes"] += 1
+            pool.peak = pool.in_flight
+
+        for retired in list(self._retiring):
+            client, transport = retired
+            if transport.in_flight <= 0:
+                self._retiring.remove(retired)
+                await client.aclose()
+
+    async def resize_loop(self):
+        while True:
+            await asyncio.sleep(HTTP_POOL_RESIZE_INTERVAL)
+            try:
+                await self._resize()
+            except Exception as e:
+                print(f"HTTP pool resize failed: {e}")
+
+    def start(self):
+        if self._resizer is None:
+            self._resizer = asyncio.create_task(self.resize_loop())
+
+    async def aclose(self):
+        if self._resizer:
+            self._resizer.cancel()
+            try:
+                await self._resizer
+            except asyncio.CancelledError:
+                pass
+            self._resizer = None
+        for client in [p.client for p in self._pools.values()] + [c for c, _ in self._retiring]:
+            await client.aclose()
+        self._pools.clear()
+        self._retiring = []
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "http2": self.http2,
+            "retiring_clients": len(self._retiring),
+            "hosts": {host: pool.get_stats() for host, pool in self._pools.items()},
+        }
+
+http_pool = HTTPPoolManager()
@@ -0,0 +1,178 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional
+from services.stream_cache import stream_cache
+from services.extraction_engine import PRIORITY_PREWARM
+
+# Extractions the prewarmer may run at once in this process
+PREWARM_CONCURRENCY = int(os.getenv("PREWARM_CONCURRENCY", "2"))
+# Jobs still queued after this long are no longer worth running
+PREWARM_JOB_TTL = 120
+PREWARM_MAX_QUEUE = 200
+# How many prewarmed ids are remembered for the hit rate
+PREWARM_HISTORY = 1000
+# A video prewarmed this recently isn't queued again
+PREWARM_RECENT = 600
+
+# Base priorities per source (lower runs first); the result rank is added on top
+PRIORITY_SEARCH = 0
+PRIORITY_AUTOPLAY = 10
+PRIORITY_RECOMMENDATION = 20
+
+class _Job:
+    __slots__ = ("video_id", "priority", "seq", "enqueued_at", "group")
+
+    def __init__(self, video_id: str, priority: int, seq: int, group: Optional[str]):
+        self.video_id = video_id
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = time.time()
+        self.group = group
+
+class PrewarmScheduler:
+    """
+    Per-process queue of stream URLs to resolve ahead of playback.
+
+    A video is queued once (at its most urgent priority), a fixed number of
+    workers drain the queue, and jobs that waited too long or were superseded
+    by a newer schedule from the same group (e.g. the same user's next search)
+    are dropped.
+    """
+
+    def __init__(self, concurrency: int = PREWARM_CONCURRENCY, job_ttl: int = PREWARM_JOB_TTL,
+                 max_queue: int = PREWARM_MAX_QUEUE):
+        self.concurrency = concurrency
+        self.job_ttl = job_ttl
+        self.max_queue = max_queue
+        self._heap: List[tuple] = []
+        self._jobs: Dict[str, _Job] = {}
+        self._groups: Dict[str, set] = {}
+        self._running: set = set()
+        self._prewarmed: "OrderedDict[str, float]" = OrderedDict()
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+        self.stats = {"scheduled": 0, "deduped": 0, "superseded": 0, "stale": 0, "dropped": 0,
+                      "completed": 0, "already_cached": 0, "failed": 0, "plays": 0, "hits": 0}
+
+    def schedule(self, video_ids: Iterable[str], priority: int = PRIORITY_SEARCH, group: str = None):
+        """Queues video ids in rank order. A new schedule for a group replaces its queued jobs."""
+        video_ids = [v for v in video_ids if v]
+        if group is not None:
+            for old in self._groups.pop(group, set()) - set(video_ids):
+                if self._drop(old):
+                    self.stats["superseded"] += 1
+
+        for rank, video_id in enumerate(video_ids):
+            self.stats["scheduled"] += 1
+            job_priority = priority + rank
+            job = self._jobs.get(video_id)
+            if video_id in self._running or time.time() - self._prewarmed.get(video_id, 0) < PREWARM_RECENT:
+                self.stats["deduped"] += 1
+                continue
+            if job is not None:
+                self.stats["deduped"] += 1
+                if job_priority >= job.priority:
+                    continue
+                # Re-push at the better priority; the old heap entry is skipped by seq
+                self._jobs.pop(video_id)
+            elif len(self._jobs) >= self.max_queue:
+                self.stats["dropped"] += 1
+                continue
+
+            job = _Job(video_id, job_priority, next(self._seq), group)
+            self._jobs[video_id] = job
+            heapq.heappush(self._heap, (job.priority, job.seq, video_id))
+            if group is not None:
+                self._groups.setdefault(group, set()).add(video_id)
+
+        if self._wakeup and self._jobs:
+            self._wakeup.set()
+
+    def _drop(self, video_id: str) -> bool:
+        job = self._jobs.pop(video_id, None)
+        if job is None:
+            return False
+        if job.group is not None and job.group in self._groups:
+            self._groups[job.group].discard(video_id)
+            if not self._groups[job.group]:
+                del self._groups[job.group]
+        return True
+
+    def _next_job(self) -> Optional[_Job]:
+        while self._heap:
+            _, seq, video_id = heapq.heappop(self._heap)
+            job = self._jobs.get(video_id)
+            if job is None or job.seq != seq:
+                continue
+            self._drop(video_id)
+            if time.time() - job.enqueued_at > self.job_ttl:
+                self.stats["stale"] += 1
+                continue
+            return job
+        return None
+
+    async def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            video_id = job.video_id
+            self._running.add(video_id)
+            try:
+                if await stream_cache.get(video_id, track=False):
+                    self.stats["already_cached"] += 1
+                elif await stream_cache.extract(video_id, priority=PRIORITY_PREWARM):
+                    self.stats["completed"] += 1
+                else:
+                    self.stats["failed"] += 1
+                    continue
+                self._prewarmed[video_id] = time.time()
+                self._prewarmed.move_to_end(video_id)
+                while len(self._prewarmed) > PREWARM_HISTORY:
+                    self._prewarmed.popitem(last=False)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"Pre-warm failed for {video_id}: {e}")
+            finally:
+                self._running.discard(video_id)
+
+    def record_play(self, video_id: str):
+        """Called once per playback (its opening /stream request) to measure how often prewarming paid off."""
+        self.stats["plays"] += 1
+        if video_id in self._prewarmed:
+            self.stats["hits"] += 1
+
+    def start(self):
+        if self._workers:
+            return
+        self._wakeup = asyncio.Event()
+        if self._jobs:
+            self._wakeup.set()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def get_stats(self) -> Dict[str, Any]:
+        plays = self.stats["plays"]
+        return {
+            **self.stats,
+            "queue_depth": len(self._jobs),
+            "running": len(self._running),
+            "hit_rate": round(self.stats["hits"] / plays, 3) if plays else None,
+        }
+
+prewarm_scheduler = PrewarmScheduler()
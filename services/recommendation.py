@@ -1,11 +1,12 @@
 from typing import List, Dict, Any
 import random
-from services.firebase_db import firebase_db
 from services.search import search_service
 from services.youtube import yt_service
 from services.ml_recommender import ml_recommender
 from services.spotify_recommender import spotify_recommender
-import asyncio
+from services.prewarm import prewarm_scheduler, PRIORITY_AUTOPLAY
+from services.stream_prefix import stream_prefix
+from services.user_profile import profile_cache
 
 class RecommendationService:
     async def get_personalized_recommendations(self, user_id: str):
@@ -26,10 +27,10 @@ class RecommendationService:
 
         # 2. Strategy A: Based on Favorite Artists
         try:
-            top_artists = firebase_db.get_frequent_artists(user_id, limit=5)
-            user_likes = firebase_db.get_liked_songs(user_id)
-            for s in user_likes:
-                seen_ids.add(s.get('id') or s.get('video_id'))
+            profile = await profile_cache.get(user_id)
+            top_artists = profile.frequent_artists(limit=5) if profile else []
+            if profile:
+                seen_ids.update(profile.liked_ids())
         except Exception as e:
             print(f"Error fetching user profile: {e}")
             top_artists = []
@@ -45,7 +46,8 @@ class RecommendationService:
 
         # 3. Strategy B: Spotify Recommender (Content-Based)
         if spotify_recommender.enabled and len(recommendations) < 20:
-            history = firebase_db.get_play_history(user_id, limit=10)
+            profile = await profile_cache.get(user_id)
+            history = profile.recent_history(limit=10) if profile else []
             history_ids = [h.get('song_id') or h.get('video_id') for h in history if h.get('song_id') or h.get('video_id')]
             
             spotify_recs = spotify_recommender.recommend_for_user(history_ids, top_n=15)
@@ -71,7 +73,8 @@ class RecommendationService:
 
     async def get_daily_mix(self, user_id: str):
         try:
-            top_artists = firebase_db.get_frequent_artists(user_id, limit=30)
+            profile = await profile_cache.get(user_id)
+            top_artists = profile.frequent_artists(limit=30) if profile else []
             if not top_artists:
                 return await search_service.search_songs("lofi chill beats for study", limit=12, user_id=user_id)
             
@@ -82,7 +85,8 @@ class RecommendationService:
 
     async def get_recent_context(self, user_id: str):
         try:
-            history = firebase_db.get_play_history(user_id, limit=1)
+            profile = await profile_cache.get(user_id)
+            history = profile.recent_history(limit=1) if profile else []
             if not history: return {"last_song": None, "recommendations": []}
                 
             last_song = history[0]
@@ -112,11 +116,16 @@ class RecommendationService:
             # Similarity keywords
             search_query = f"songs similar to current track {current_song_id}"
             results = await search_service.search_songs(search_query, limit=5, user_id=user_id)
-            candidates = [s for s in results if s['id'] not in seen_ids]
-            if candidates: return candidates[:3]
+            candidates = [s for s in results if s['id'] not in seen_ids][:3]
+            if not candidates:
+                # Fallback
+                candidates = await search_service.search_songs("top hits global 2024", limit=3, user_id=user_id)
 
-            # Fallback
-            return await search_service.search_songs("top hits global 2024", limit=3, user_id=user_id)
+            # The likeliest next plays: resolve their streams ahead of time
+            prewarm_scheduler.schedule([s['id'] for s in candidates], priority=PRIORITY_AUTOPLAY, group=f"autoplay:{user_id}")
+            # and hold the opening bytes of the first one so the transition is gapless
+            stream_prefix.schedule([s['id'] for s in candidates[:1]], group=f"autoplay:{user_id}")
+            return candidates
         except Exception as e:
             print(f"Autoplay Error: {e}")
             return []
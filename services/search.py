@@ -1,7 +1,20 @@
-import yt_dlp
+import os
 import re
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any
 import asyncio
+from services.cache import redis_client
+from services.codec import redis_codec
+from services.singleflight import SingleFlight
+from services.trusted_channels import trusted_channels
+from services.ydl_pool import ydl_pool
+
+# Titles that look like music/podcasts survive the final low-score threshold
+AUDIO_HINT = re.compile(r"song|audio|podcast|music")
+# yt-dlp searches in flight per worker; they run on their own threads so a burst
+# of keystrokes can't occupy the default executor that segment I/O relies on
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", "4"))
 
 class SearchService:
     def __init__(self):
@@ -12,6 +25,63 @@ class SearchService:
             'extract_flat': True,
             'default_search': 'ytsearch',
         }
+        ydl_pool.register("search", lambda: dict(self.ydl_opts), warm_extractors=["YoutubeSearch"])
+        self.languages = ["malayalam", "hindi", "tamil", "english", "telugu", "kannada", "punjabi", "spanish", "korean"]
+        # Raw ytsearch entries are shared by every user; personalization is applied per request
+        self.raw_cache_ttl = 3600
+        # Identical in-flight searches share a single yt-dlp extraction
+        self.flight = SingleFlight("search", redis=redis_client)
+        self._executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="search")
+        self.stats = {"raw_hits": 0, "raw_misses": 0}
+
+    def canonical_query(self, query: str) -> str:
+        """Canonical form of a query: the key of the shared raw-results tier and the text sent to YouTube."""
+        text = unicodedata.normalize("NFKC", query or "").lower()
+        text = " ".join(text.split())
+
+        # Intent Detection (Language check)
+        if self.normalize(text) in self.languages:
+            text = f"{text} songs official audio"
+        return text
+
+    def slim_entry(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        """Keeps only the fields ranking needs, so cached raw entries stay small."""
+        thumbnails = entry.get('thumbnails') or [{}]
+        return {
+            "id": entry.get('id'),
+            "title": entry.get('title') or '',
+            "uploader": entry.get('uploader') or '',
+            "duration": entry.get('duration') or 0,
+            "view_count": entry.get('view_count') or 0,
+            "thumbnail": thumbnails[0].get('url'),
+        }
+
+    async def get_raw_entries(self, search_query: str) -> List[Dict[str, Any]]:
+        cache_key = f"ytsearch:{search_query}"
+        cached = await redis_client.get(cache_key)
+        if cached:
+            self.stats["raw_hits"] += 1
+            return redis_codec.decode(cached)
+        self.stats["raw_misses"] += 1
+
+        loop = asyncio.get_running_loop()
+
+        def _blocking_search():
+            with ydl_pool.checkout("search") as ydl:
+                # Reduced from 40 to 20 to save metadata overhead
+                search_results = ydl.extract_info(f"ytsearch20:{search_query}", download=False)
+                return [self.slim_entry(e) for e in search_results.get('entries', []) if e]
+
+        async def _fetch():
+            entries = await loop.run_in_executor(self._executor, _blocking_search)
+            if entries:
+                await redis_client.setex(cache_key, self.raw_cache_ttl, redis_codec.encode(entries))
+            return entries
+
+        return await self.flight.do(search_query, _fetch)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "flight": self.flight.get_stats()}
 
     def normalize(self, text: str) -> str:
         from services.trusted_channels import trusted_channels
@@ -44,14 +114,14 @@ class SearchService:
         if q in t: score += 20
         return score
 
-    def get_personal_context(self, user_id: str) -> Dict[str, Any]:
+    async def get_personal_context(self, user_id: str) -> Dict[str, Any]:
         if not user_id:
             return {"liked_artists": set(), "skipped_artists": set()}
         
-        from services.firebase_db import firebase_db
-        liked = firebase_db.get_liked_songs(user_id)
-        # Liked artists extraction
-        liked_artists = {self.normalize(s.get('artist', '')) for s in liked if s.get('artist')}
+        from services.user_profile import profile_cache
+        profile = await profile_cache.get(user_id)
+        # Liked artists, already normalized and kept current by the profile cache
+        liked_artists = set(profile.liked_artists) if profile else set()
         skipped_artists = set()
         
         return {
@@ -60,40 +130,32 @@ class SearchService:
         }
 
     async def search_songs(self, query: str, limit: int = 10, user_id: str = None) -> List[Dict[str, Any]]:
-        loop = asyncio.get_running_loop()
-        
-        # 1. Intent Detection (Language check)
-        languages = ["malayalam", "hindi", "tamil", "english", "telugu", "kannada", "punjabi", "spanish", "korean"]
-        q_norm = self.normalize(query)
-        
-        search_query = query
-        if q_norm in languages:
-            search_query = f"{query} songs official audio"
+        # 1. Canonical query (shared across users)
+        search_query = self.canonical_query(query)
 
         # 2. Get User Context
         try:
-            context = self.get_personal_context(user_id)
+            context = await self.get_personal_context(user_id)
         except:
             context = {"liked_artists": set(), "skipped_artists": set()}
             
         liked_artists = context["liked_artists"]
         skipped_artists = context["skipped_artists"]
 
-        def _blocking_search():
-            with yt_dlp.YoutubeDL(self.ydl_opts) as ydl:
-                # Reduced from 40 to 20 to save metadata overhead
-                search_results = ydl.extract_info(f"ytsearch20:{search_query}", download=False)
-                return search_results.get('entries', [])
-
         try:
-            entries = await loop.run_in_executor(None, _blocking_search)
-            
+            entries = await self.get_raw_entries(search_query)
+
+            # 3. Re-rank the shared entries for this user
+            entries = [e for e in entries if e]
+            # Keyword scoring for the whole batch: each title/channel/query is normalized once
+            batch_scores = trusted_channels.score_entries(entries, search_query)
+
             candidates = []
             seen_ids = set()
             seen_titles_durations = []
 
-            for entry in entries:
-                if not entry or entry.get('id') in seen_ids:
+            for entry, scored in zip(entries, batch_scores):
+                if entry.get('id') in seen_ids:
                     continue
                 
                 title = entry.get('title', '').strip()
@@ -101,14 +163,12 @@ class SearchService:
                 duration = entry.get('duration', 0)
                 view_count = entry.get('view_count', 0)
                 
-                if self.contains_negative(title, search_query):
+                if scored.spam:
                     continue
 
                 # --- ADVANCED FILTERING & AI SCORING ---
-                from services.trusted_channels import trusted_channels
-                
                 # 1. Official/Basic Trust Score
-                trust_score = self.get_official_score(channel, title)
+                trust_score = scored.trust
                 
                 # 2. AI Classification Check
                 ai_info = await trusted_channels.get_ai_trust_score(channel, [title])
@@ -120,7 +180,7 @@ class SearchService:
 
                 # Base score
                 score = 0
-                score += self.get_match_score(search_query, title)
+                score += scored.match
                 score += trust_score
                 score += self.get_duration_score(duration)
                 score += ai_info # Add AI semantic trust
@@ -130,7 +190,7 @@ class SearchService:
                 elif view_count and view_count > 1000000: score += 10
 
                 # --- PERSONALIZATION LAYER ---
-                c_norm = self.normalize(channel)
+                c_norm = scored.channel_norm
                 if c_norm in liked_artists:
                     score += 50 # Massive boost for favorite artists
                 if c_norm in skipped_artists:
@@ -139,7 +199,7 @@ class SearchService:
                 
                 # FINAL THRESHOLD: If it's not music/podcasts it should have a very low score
                 # Discard anything with too low score to be legitimate audio
-                if score < 20 and not any(k in title.lower() for k in ["song", "audio", "podcast", "music"]):
+                if score < 20 and not AUDIO_HINT.search(title.lower()):
                     continue
 
                 is_duplicate = False
@@ -158,7 +218,7 @@ class SearchService:
                     "title": title,
                     "artist": channel,
                     "duration": duration,
-                    "thumbnail": entry.get('thumbnails', [{}])[0].get('url'),
+                    "thumbnail": entry.get('thumbnail'),
                     "score": score
                 })
                 
@@ -0,0 +1,244 @@
+import asyncio
+import mmap
+import os
+import re
+from collections import OrderedDict
+from typing import AsyncIterator, Callable, Dict, Optional, Tuple
+
+SEGMENT_CACHE_DIR = os.getenv("SEGMENT_CACHE_DIR", "/tmp/sonicstream-segments")
+# Fixed segment size; a range request is served as a run of whole segments
+SEGMENT_SIZE = 256 * 1024
+# Bytes this process keeps on disk before evicting least recently used segments
+SEGMENT_CACHE_MAX_BYTES = int(os.getenv("SEGMENT_CACHE_MAX_MB", "512")) * 1024 * 1024
+
+SAFE_KEY = re.compile(r"[^A-Za-z0-9_-]")
+RANGE_HEADER = re.compile(r"bytes=(\d*)-(\d*)")
+
+# fetch(start, end) -> async iterator over upstream bytes [start, end] (inclusive)
+Fetcher = Callable[[int, int], AsyncIterator[bytes]]
+
+class RangeNotSatisfiable(ValueError):
+    """A valid Range header that selects no bytes of the stream (answered with a 416)."""
+
+def parse_range(header: Optional[str], total: int) -> Optional[Tuple[int, int]]:
+    """
+    Resolves a Range header against the total length into an inclusive (start, end).
+    Returns None without a header or for one that isn't a valid bytes range, which
+    is then ignored and the whole stream served with a 200 (RFC 9110). Raises
+    RangeNotSatisfiable if the range can't be satisfied.
+    Only the first range of a multi-range request is honoured.
+    """
+    if not header:
+        return None
+    m = RANGE_HEADER.fullmatch(header.split(",")[0].strip())
+    if not m or (not m.group(1) and not m.group(2)):
+        return None
+    if not m.group(1):
+        # Suffix range: the last N bytes
+        length = int(m.group(2))
+        if length == 0:
+            raise RangeNotSatisfiable(header)
+        return (max(0, total - length), total - 1)
+    start = int(m.group(1))
+    if m.group(2) and int(m.group(2)) < start:
+        # Invalid rather than unsatisfiable
+        return None
+    if start >= total:
+        raise RangeNotSatisfiable(header)
+    end = int(m.group(2)) if m.group(2) else total - 1
+    return (start, min(end, total - 1))
+
+class SegmentCache:
+    """
+    Disk cache of fixed-size byte-range segments of upstream audio.
+
+    Segments live in {dir}/{key}/{index} and are read back through mmap. A request
+    is served from whichever segments are on disk, and only the missing runs are
+    fetched from upstream (and written back as they complete). The key identifies
+    the exact byte stream (video, itag and length), so a different format never
+    mixes with cached bytes.
+
+    The directory is shared by all workers; each worker tracks the segments it
+    has seen in an LRU and evicts beyond its byte budget.
+    """
+
+    def __init__(self, directory: str = SEGMENT_CACHE_DIR, segment_size: int = SEGMENT_SIZE,
+                 max_bytes: int = SEGMENT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self._lru: "OrderedDict[Tuple[str, int], int]" = OrderedDict()
+        self._bytes = 0
+        self.stats = {"segment_hits": 0, "segment_misses": 0, "bytes_from_disk": 0,
+                      "bytes_from_upstream": 0, "evictions": 0}
+
+    def key(self, video_id: str, itag, content_length: int) -> str:
+        return SAFE_KEY.sub("_", f"{video_id}-{itag or 0}-{content_length}")
+
+    def _path(self, key: str, index: int) -> str:
+        return os.path.join(self.directory, key, str(index))
+
+    def load(self):
+        """Indexes segments already on disk, oldest first. Blocking; run at startup."""
+        found = []
+        try:
+            for key in os.listdir(self.directory):
+                key_dir = os.path.join(self.directory, key)
+                for name in os.listdir(key_dir):
+                    if name.isdigit():
+                        st = os.stat(os.path.join(key_dir, name))
+                        found.append((st.st_mtime, key, int(name), st.st_size))
+        except FileNotFoundError:
+            return
+        for _, key, index, size in sorted(found):
+            self._remember(key, index, size)
+        self._evict()
+
+    def _remember(self, key: str, index: int, size: int):
+        old = self._lru.pop((key, index), None)
+        if old is not None:
+            self._bytes -= old
+        self._lru[(key, index)] = size
+        self._bytes += size
+
+    def _forget(self, key: str, index: int):
+        size = self._lru.pop((key, index), None)
+        if size is not None:
+            self._bytes -= size
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._lru:
+            (key, index), size = self._lru.popitem(last=False)
+            self._bytes -= size
+            self.stats["evictions"] += 1
+            try:
+                os.unlink(self._path(key, index))
+            except OSError:
+                pass
+
+    def has(self, key: str, index: int) -> bool:
+        if (key, index) in self._lru:
+            return True
+        # Possibly written by another worker
+        try:
+            size = os.path.getsize(self._path(key, index))
+        except OSError:
+            return False
+        self._remember(key, index, size)
+        return True
+
+    def _read_blocking(self, key: str, index: int, start: int, end: int) -> bytes:
+        with open(self._path(key, index), "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return mm[start:end]
+
+    def _write_blocking(self, key: str, index: int, data: bytes):
+        path = self._path(key, index)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so readers in other workers never see a partial segment
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    async def _read(self, key: str, index: int, start: int, end: int) -> Optional[bytes]:
+        try:
+            data = await asyncio.get_running_loop().run_in_executor(
+                None, self._read_blocking, key, index, start, end)
+        except (OSError, ValueError):
+            # Evicted by another worker in the meantime
+            self._forget(key, index)
+            return None
+        self._lru.move_to_end((key, index))
+        return data
+
+    async def _write(self, key: str, index: int, data: bytes):
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write_blocking, key, index, data)
+        except OSError as e:
+            print(f"Segment write failed for {key}/{index}: {e}")
+            return
+        self._remember(key, index, len(data))
+        self._evict()
+
+    def _segment_length(self, index: int, total: int) -> int:
+        return min(self.segment_size, total - index * self.segment_size)
+
+    async def serve(self, key: str, start: int, end: int, total: int, fetch: Fetcher) -> AsyncIterator[bytes]:
+        """Yields bytes [start, end] (inclusive) from disk, filling missing segments from upstream."""
+        size = self.segment_size
+        index = start // size
+        last = end // size
+        while index <= last:
+            seg_start = index * size
+            if self.has(key, index):
+                lo = max(start, seg_start) - seg_start
+                hi = min(end + 1, seg_start + size) - seg_start
+                data = await self._read(key, index, lo, hi)
+                if data is not None:
+                    self.stats["segment_hits"] += 1
+                    self.stats["bytes_from_disk"] += len(data)
+                    yield data
+                    index += 1
+                    continue
+
+            # Upstream fill of the run of missing segments starting here
+            run_end = index
+            while run_end < last and not self.has(key, run_end + 1):
+                run_end += 1
+            self.stats["segment_misses"] += run_end - index + 1
+            async for data in self._fill(key, index, run_end, start, end, total, fetch):
+                yield data
+            index = run_end + 1
+
+    async def _fill(self, key: str, first: int, last: int, start: int, end: int, total: int,
+                    fetch: Fetcher) -> AsyncIterator[bytes]:
+        size = self.segment_size
+        pos = first * size
+        fetch_end = min((last + 1) * size, total) - 1
+        index = first
+        buf = bytearray()
+        async for chunk in fetch(pos, fetch_end):
+            self.stats["bytes_from_upstream"] += len(chunk)
+            # Forward the part of the chunk the client asked for right away
+            lo = max(start, pos)
+            hi = min(end + 1, pos + len(chunk))
+            if hi - lo == len(chunk):
+                yield chunk
+            elif hi > lo:
+                yield memoryview(chunk)[lo - pos:hi - pos]
+            pos += len(chunk)
+
+            buf += chunk
+            while index <= last and len(buf) >= self._segment_length(index, total):
+                seg_len = self._segment_length(index, total)
+                # A concurrent listener on a shared download may have written it already
+                if not self.has(key, index):
+                    await self._write(key, index, bytes(buf[:seg_len]))
+                del buf[:seg_len]
+                index += 1
+        if pos <= fetch_end:
+            raise IOError(f"upstream ended at byte {pos}, expected {fetch_end + 1}")
+
+    async def record(self, key: str, source: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """
+        Passes source through while writing it to disk as segments, for streams whose
+        total length is only known once they end. The trailing partial segment is only
+        written if the source completes.
+        """
+        index = 0
+        buf = bytearray()
+        async for chunk in source:
+            yield chunk
+            buf += chunk
+            while len(buf) >= self.segment_size:
+                await self._write(key, index, bytes(buf[:self.segment_size]))
+                del buf[:self.segment_size]
+                index += 1
+        if buf:
+            await self._write(key, index, bytes(buf))
+
+    def get_stats(self) -> Dict[str, int]:
+        return {**self.stats, "segments": len(self._lru), "bytes": self._bytes}
+
+segment_cache = SegmentCache()
@@ -0,0 +1,96 @@
+import asyncio
+import uuid
+from typing import Any, Awaitable, Callable, Dict
+from services.codec import redis_codec
+
+class SingleFlight:
+    """
+    Coalesces identical in-flight calls so only one of them does the work.
+
+    Inside a process, callers for the same key await one shared task. Across
+    uvicorn workers, the first worker to grab a short Redis lease runs the call
+    and publishes the result; the other workers wait for it instead of
+    repeating the work.
+    """
+
+    def __init__(self, namespace: str, redis=None, lease_ms: int = 20000,
+                 result_ttl: int = 30, poll_interval: float = 0.1):
+        self.namespace = namespace
+        self.redis = redis
+        self.lease_ms = lease_ms
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.stats = {
+            "calls": 0,
+            "executed": 0,
+            "coalesced_local": 0,
+            "coalesced_remote": 0,
+            "lease_timeouts": 0,
+        }
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]],
+                 encode: Callable[[Any], str] = redis_codec.encode,
+                 decode: Callable[[str], Any] = redis_codec.decode) -> Any:
+        self.stats["calls"] += 1
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats["coalesced_local"] += 1
+        else:
+            # Run the shared work in its own task so a cancelled caller
+            # (e.g. a disconnected client) doesn't cancel it for everyone else.
+            task = asyncio.ensure_future(self._lead(key, fn, encode, decode))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved even if every caller went away
+            task.exception()
+
+    async def _lead(self, key, fn, encode, decode):
+        if self.redis is None:
+            self.stats["executed"] += 1
+            return await fn()
+
+        lease_key = f"sf:{self.namespace}:lease:{key}"
+        result_key = f"sf:{self.namespace}:result:{key}"
+        token = uuid.uuid4().hex
+
+        if await self.redis.set(lease_key, token, nx=True, px=self.lease_ms):
+            self.stats["executed"] += 1
+            try:
+                result = await fn()
+                await self.redis.setex(result_key, self.result_ttl, encode(result))
+                return result
+            finally:
+                if await self.redis.get(lease_key) == token:
+                    await self.redis.delete(lease_key)
+
+        # Another worker holds the lease: wait for its result
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.lease_ms / 1000
+        while loop.time() < deadline:
+            cached = await self.redis.get(result_key)
+            if cached is not None:
+                self.stats["coalesced_remote"] += 1
+                return decode(cached)
+            if await self.redis.get(lease_key) is None:
+                # Leader failed (or Redis is unavailable); one last look, then run it ourselves
+                cached = await self.redis.get(result_key)
+                if cached is not None:
+                    self.stats["coalesced_remote"] += 1
+                    return decode(cached)
+                break
+            await asyncio.sleep(self.poll_interval)
+        else:
+            self.stats["lease_timeouts"] += 1
+
+        self.stats["executed"] += 1
+        return await fn()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "inflight": len(self._inflight)}
@@ -0,0 +1,133 @@
+import asyncio
+import os
+import time
+from typing import Any, Dict, List, Optional
+from services.cache import redis_client
+from services.youtube import yt_service, StreamInfo
+from services.extraction_engine import PRIORITY_INTERACTIVE, PRIORITY_REFRESH
+
+# Used when a URL carries no expiry information
+STREAM_URL_DEFAULT_TTL = 3600
+# Stop serving a URL this many seconds before googlevideo says it expires
+STREAM_URL_SAFETY_MARGIN = int(os.getenv("STREAM_URL_SAFETY_MARGIN", "300"))
+# Hot entries are re-extracted when they are this close to their cache expiry
+STREAM_REFRESH_WINDOW = int(os.getenv("STREAM_REFRESH_WINDOW", "600"))
+STREAM_REFRESH_INTERVAL = 30
+# An entry counts as hot with this many reads within the hot window
+STREAM_HOT_MIN_HITS = 2
+STREAM_HOT_WINDOW = 1800
+
+class StreamCache:
+    """
+    Caches extracted StreamInfo records in Redis under stream:{video_id} with a TTL taken
+    from the URL's own expiry, and keeps frequently played entries fresh in the background.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        # video_id -> {"hits", "last_hit", "expires_at"}; per process
+        self._hot: Dict[str, Dict[str, float]] = {}
+        self._refresher: Optional[asyncio.Task] = None
+        self.stats = {"hits": 0, "misses": 0, "extractions": 0, "refreshes": 0, "refresh_failures": 0}
+
+    def key(self, video_id: str) -> str:
+        return f"stream:{video_id}"
+
+    def ttl_for(self, info: StreamInfo) -> int:
+        """Seconds the URL may be cached, or 0 if it is already too close to expiring."""
+        if info.expires_at is None:
+            return STREAM_URL_DEFAULT_TTL
+        return max(0, int(info.expires_at - time.time()) - STREAM_URL_SAFETY_MARGIN)
+
+    def _track(self, video_id: str, info: StreamInfo):
+        entry = self._hot.setdefault(video_id, {"hits": 0, "last_hit": 0, "expires_at": 0})
+        entry["hits"] += 1
+        entry["last_hit"] = time.time()
+        entry["expires_at"] = time.time() + self.ttl_for(info)
+
+    async def get(self, video_id: str, track: bool = True) -> Optional[StreamInfo]:
+        """track=False for lookups that aren't plays (search enrichment, prewarm checks)."""
+        info = StreamInfo.loads(await self.redis.get(self.key(video_id)))
+        if info:
+            self.stats["hits"] += 1
+            if track:
+                self._track(video_id, info)
+        else:
+            self.stats["misses"] += 1
+        return info
+
+    async def get_many(self, video_ids: List[str]) -> Dict[str, StreamInfo]:
+        """Cached records for several videos in one round trip (not counted as plays)."""
+        video_ids = list(dict.fromkeys(v for v in video_ids if v))
+        raw = await self.redis.mget([self.key(v) for v in video_ids])
+        found = {}
+        for video_id, value in zip(video_ids, raw):
+            info = StreamInfo.loads(value)
+            if info:
+                found[video_id] = info
+        self.stats["hits"] += len(found)
+        self.stats["misses"] += len(video_ids) - len(found)
+        return found
+
+    async def set(self, video_id: str, info: StreamInfo) -> bool:
+        ttl = self.ttl_for(info)
+        if ttl <= 0:
+            return False
+        if video_id in self._hot:
+            self._hot[video_id]["expires_at"] = time.time() + ttl
+        return await self.redis.setex(self.key(video_id), ttl, info.dumps())
+
+    async def extract(self, video_id: str, priority: int = PRIORITY_INTERACTIVE) -> Optional[StreamInfo]:
+        """Runs a fresh extraction and caches the resulting record."""
+        self.stats["extractions"] += 1
+        info = await yt_service.get_stream_url(video_id, priority=priority)
+        if info:
+            await self.set(video_id, info)
+            return info
+        return None
+
+    async def _refresh(self, video_id: str):
+        # Another worker may already have refreshed it
+        current = StreamInfo.loads(await self.redis.get(self.key(video_id)))
+        if current and self.ttl_for(current) > STREAM_REFRESH_WINDOW:
+            self._hot[video_id]["expires_at"] = time.time() + self.ttl_for(current)
+            return
+        if await self.extract(video_id, priority=PRIORITY_REFRESH):
+            self.stats["refreshes"] += 1
+        else:
+            self.stats["refresh_failures"] += 1
+
+    async def refresh_loop(self):
+        while True:
+            await asyncio.sleep(STREAM_REFRESH_INTERVAL)
+            now = time.time()
+            for video_id, entry in list(self._hot.items()):
+                if now - entry["last_hit"] > STREAM_HOT_WINDOW:
+                    del self._hot[video_id]
+                    continue
+                if entry["hits"] < STREAM_HOT_MIN_HITS:
+                    continue
+                if entry["expires_at"] - now < STREAM_REFRESH_WINDOW:
+                    try:
+                        await self._refresh(video_id)
+                    except Exception as e:
+                        self.stats["refresh_failures"] += 1
+                        print(f"Stream URL refresh failed for {video_id}: {e}")
+
+    def start(self):
+        if self._refresher is None:
+            self._refresher = asyncio.create_task(self.refresh_loop())
+
+    async def stop(self):
+        if self._refresher:
+            self._refresher.cancel()
+            try:
+                await self._refresher
+            except asyncio.CancelledError:
+                pass
+            self._refresher = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "tracked": len(self._hot)}
+
+stream_cache = StreamCache(redis_client)
@@ -0,0 +1,169 @@
+import asyncio
+import itertools
+import os
+from collections import deque
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+# Bytes of recent upstream data kept per shared download
+FANOUT_BUFFER_BYTES = int(os.getenv("FANOUT_BUFFER_KB", "2048")) * 1024
+# How far the download may run ahead of its fastest listener
+FANOUT_READ_AHEAD = FANOUT_BUFFER_BYTES // 2
+# A request may join a download whose head is at most this far behind its start
+FANOUT_JOIN_AHEAD = 256 * 1024
+
+Fetcher = Callable[[int, int], AsyncIterator[bytes]]
+
+class _Upstream:
+    """One upstream download of bytes [start, end] and the listeners reading from it."""
+
+    def __init__(self, key: str, start: int, end: int):
+        self.key = key
+        self.start = start
+        self.end = end
+        self.ring = deque()  # (offset, chunk)
+        self.ring_bytes = 0
+        self.head = start  # offset one past the last received byte
+        self.done = False
+        # The source ran to its end (rather than failing or being abandoned)
+        self.eof = False
+        self.positions: Dict[int, int] = {}  # listener id -> next offset it needs
+        self.changed = asyncio.Condition()
+        # The loop only keeps weak references to tasks; this one must outlive its creator's frame
+        self.pump: Optional[asyncio.Task] = None
+
+    @property
+    def tail(self) -> int:
+        return self.ring[0][0] if self.ring else self.head
+
+class StreamFanout:
+    """
+    Lets concurrent requests for the same byte stream share one upstream download.
+
+    A request whose range starts inside (or just ahead of) an active download's
+    ring buffer, and ends within that download, subscribes to it instead of
+    opening its own connection. The
+    download is paced by its fastest listener; a listener that falls behind the
+    ring buffer is detached onto its own upstream connection, so one slow client
+    never stalls the others.
+    """
+
+    def __init__(self, buffer_bytes: int = FANOUT_BUFFER_BYTES, read_ahead: int = FANOUT_READ_AHEAD,
+                 join_ahead: int = FANOUT_JOIN_AHEAD):
+        self.buffer_bytes = buffer_bytes
+        self.read_ahead = read_ahead
+        self.join_ahead = join_ahead
+        self._upstreams: Dict[str, List[_Upstream]] = {}
+        self._ids = itertools.count()
+        self.stats = {"upstreams": 0, "joined": 0, "detached": 0, "bytes_shared": 0}
+
+    def fetcher(self, key: str, fetch: Fetcher) -> Fetcher:
+        """Wraps fetch(start, end) so overlapping fetches for the same key share one download."""
+        def shared_fetch(start: int, end: int) -> AsyncIterator[bytes]:
+            return self._read(key, start, end, fetch)
+        return shared_fetch
+
+    def _find(self, key: str, start: int, end: int):
+        # Only downloads that cover the whole range; a continuation past up.end would
+        # open a second connection anyway
+        for up in self._upstreams.get(key, []):
+            if not up.done and up.tail <= start <= up.head + self.join_ahead and end <= up.end:
+                return up
+        return None
+
+    async def _pump(self, up: _Upstream, fetch: Fetcher):
+        source = fetch(up.start, up.end)
+        try:
+            async for chunk in source:
+                async with up.changed:
+                    # Don't run further ahead of the fastest listener than the read-ahead allows
+                    await up.changed.wait_for(
+                        lambda: not up.positions or up.head - max(up.positions.values()) < self.read_ahead)
+                    if not up.positions:
+                        break
+                    up.ring.append((up.head, chunk))
+                    up.head += len(chunk)
+                    up.ring_bytes += len(chunk)
+                    while up.ring_bytes > self.buffer_bytes:
+                        _, old = up.ring.popleft()
+                        up.ring_bytes -= len(old)
+                    up.changed.notify_all()
+            else:
+                up.eof = True
+        except Exception as e:
+            print(f"Shared upstream for {up.key} failed at byte {up.head}: {e}")
+        finally:
+            await source.aclose()
+            async with up.changed:
+                up.done = True
+                up.changed.notify_all()
+            ups = self._upstreams.get(up.key)
+            if ups and up in ups:
+                ups.remove(up)
+                if not ups:
+                    del self._upstreams[up.key]
+
+    async def _read(self, key: str, start: int, end: int, fetch: Fetcher) -> AsyncIterator[bytes]:
+        listener = next(self._ids)
+        up = self._find(key, start, end)
+        if up is not None:
+            self.stats["joined"] += 1
+            up.positions[listener] = start
+        else:
+            self.stats["upstreams"] += 1
+            up = _Upstream(key, start, end)
+            up.positions[listener] = start
+            self._upstreams.setdefault(key, []).append(up)
+            up.pump = asyncio.create_task(self._pump(up, fetch))
+
+        pos = start
+        shared = len(up.positions) > 1
+        detached = False
+        try:
+            while pos <= end:
+                pieces = []
+                async with up.changed:
+                    await up.changed.wait_for(lambda: up.head > pos or up.done)
+                    if pos < up.tail:
+                        # Fell behind the ring buffer: continue on our own connection
+                        self.stats["detached"] += 1
+                        detached = True
+                        break
+                    for offset, chunk in up.ring:
+                        if offset + len(chunk) <= pos:
+                            continue
+                        if offset > end:
+                            break
+                        lo = pos - offset
+                        hi = min(len(chunk), end + 1 - offset)
+                        pieces.append(chunk if hi - lo == len(chunk) else memoryview(chunk)[lo:hi])
+                        pos = offset + hi
+                    up.positions[listener] = pos
+                    shared = shared or len(up.positions) > 1
+                    up.changed.notify_all()
+                    exhausted = up.done and pos >= up.head
+                for piece in pieces:
+                    if shared:
+                        self.stats["bytes_shared"] += len(piece)
+                    yield piece
+                if exhausted:
+                    # Download ended (or failed) before our range did
+                    break
+        finally:
+            async with up.changed:
+                up.positions.pop(listener, None)
+                up.changed.notify_all()
+
+        # Finish on our own connection unless the source simply ended inside our range
+        # (open-ended ranges); a download bounded before our end leaves the rest to fetch
+        if pos <= end and (detached or not up.eof or up.end < end):
+            async for chunk in fetch(pos, end):
+                yield chunk
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            **self.stats,
+            "active_upstreams": sum(len(ups) for ups in self._upstreams.values()),
+            "listeners": sum(len(up.positions) for ups in self._upstreams.values() for up in ups),
+        }
+
+stream_fanout = StreamFanout()
@@ -0,0 +1,179 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Dict, Optional
+from starlette.responses import StreamingResponse
+
+# The first bytes of a stream go out in small pieces so playback can start immediately
+STREAM_FAST_START_BYTES = 64 * 1024
+STREAM_FAST_START_CHUNK = 8 * 1024
+# Bounds for the adaptive chunk size once past the fast-start window
+STREAM_MIN_CHUNK = 16 * 1024
+STREAM_MAX_CHUNK = 256 * 1024
+# Aim for one send per this many seconds at the client's observed throughput
+STREAM_SEND_INTERVAL = 0.05
+# Upstream bytes read ahead of the client per connection
+STREAM_MAX_BUFFER = int(os.getenv("STREAM_MAX_BUFFER_KB", "512")) * 1024
+# Finished streams kept for /debug/metrics
+STREAM_RECENT = 50
+
+class _StreamRecord:
+    __slots__ = ("video_id", "started", "ttfb_ms", "bytes", "stall_ms", "send_ms", "chunk_size", "error")
+
+    def __init__(self, video_id: str, started: float):
+        self.video_id = video_id
+        self.started = started
+        self.ttfb_ms = None
+        self.bytes = 0
+        self.stall_ms = 0.0
+        self.send_ms = 0.0
+        self.chunk_size = STREAM_FAST_START_CHUNK
+        self.error = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "video_id": self.video_id,
+            "ttfb_ms": round(self.ttfb_ms, 1) if self.ttfb_ms is not None else None,
+            "bytes": self.bytes,
+            "stall_ms": round(self.stall_ms, 1),
+            "send_ms": round(self.send_ms, 1),
+            "chunk_size": self.chunk_size,
+            "error": self.error,
+        }
+
+class AudioStreamResponse(StreamingResponse):
+    """
+    StreamingResponse for the chunks the pipeline yields. ASGI bodies must be
+    bytes (BaseHTTPMiddleware re-wraps the body in a StreamingResponse that
+    would try to .encode() anything else): whole chunks go out as they are, and
+    only partial memoryview slices are copied, once, here at the boundary.
+    """
+
+    async def stream_response(self, send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        async for chunk in self.body_iterator:
+            if isinstance(chunk, memoryview):
+                whole = isinstance(chunk.obj, bytes) and chunk.nbytes == len(chunk.obj)
+                chunk = chunk.obj if whole else chunk.tobytes()
+            elif not isinstance(chunk, bytes):
+                chunk = chunk.encode(self.charset)
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+class StreamPipeline:
+    """
+    Moves upstream audio to the client.
+
+    A reader task keeps up to max_buffer bytes of upstream data queued per
+    connection, pausing when the client falls behind. The consumer cuts the
+    upstream chunks into pieces: small ones for the fast-start window, then
+    sized to the client's measured throughput, so a fast client gets large
+    sends and a slow one doesn't hold big pieces. A chunk that fits in one send
+    goes out whole; smaller pieces are memoryview slices, copied once when sent.
+    """
+
+    def __init__(self, max_buffer: int = STREAM_MAX_BUFFER):
+        self.max_buffer = max_buffer
+        self._active: Dict[int, _StreamRecord] = {}
+        self._recent: deque = deque(maxlen=STREAM_RECENT)
+        self.stats = {"streams": 0, "completed": 0, "aborted": 0, "failed": 0, "bytes": 0,
+                      "first_bytes": 0, "ttfb_ms_total": 0.0, "stall_ms_total": 0.0}
+
+    def _next_chunk_size(self, record: _StreamRecord, throughput: Optional[float]) -> int:
+        if record.bytes < STREAM_FAST_START_BYTES:
+            return STREAM_FAST_START_CHUNK
+        if throughput is None:
+            return STREAM_MIN_CHUNK
+        size = int(throughput * STREAM_SEND_INTERVAL)
+        return max(STREAM_MIN_CHUNK, min(STREAM_MAX_CHUNK, size))
+
+    async def pipe(self, video_id: str, source: AsyncIterator[bytes], started: float = None) -> AsyncIterator[Any]:
+        """Yields the bytes of source to the client. started is the request's arrival (for TTFB)."""
+        record = _StreamRecord(video_id, started or time.monotonic())
+        self._active[id(record)] = record
+        self.stats["streams"] += 1
+
+        queue = deque()
+        state = {"buffered": 0, "done": False, "error": None}
+        changed = asyncio.Condition()
+
+        async def read():
+            try:
+                async for chunk in source:
+                    async with changed:
+                        await changed.wait_for(lambda: state["buffered"] < self.max_buffer)
+                        queue.append(chunk)
+                        state["buffered"] += len(chunk)
+                        changed.notify_all()
+            except Exception as e:
+                state["error"] = e
+            finally:
+                await source.aclose()
+                async with changed:
+                    state["done"] = True
+                    changed.notify_all()
+
+        reader = asyncio.create_task(read())
+        throughput = None
+        outcome = "aborted"
+        try:
+            while True:
+                async with changed:
+                    if not queue and not state["done"]:
+                        waited = time.monotonic()
+                        await changed.wait_for(lambda: queue or state["done"])
+                        if record.ttfb_ms is not None:
+                            record.stall_ms += (time.monotonic() - waited) * 1000
+                    if not queue:
+                        break
+                    chunk = queue.popleft()
+                    state["buffered"] -= len(chunk)
+                    changed.notify_all()
+
+                view = memoryview(chunk)
+                offset = 0
+                while offset < len(view):
+                    size = self._next_chunk_size(record, throughput)
+                    record.chunk_size = size
+                    piece = chunk if offset == 0 and size >= len(view) else view[offset:offset + size]
+                    offset += len(piece)
+                    if record.ttfb_ms is None:
+                        record.ttfb_ms = (time.monotonic() - record.started) * 1000
+                    sent_at = time.monotonic()
+                    yield piece
+                    # The server awaits the socket write before resuming us, so this is send time
+                    elapsed = time.monotonic() - sent_at
+                    record.bytes += len(piece)
+                    record.send_ms += elapsed * 1000
+                    if elapsed > 0:
+                        rate = len(piece) / elapsed
+                        throughput = rate if throughput is None else 0.8 * throughput + 0.2 * rate
+
+            if state["error"] is not None:
+                outcome = "failed"
+                record.error = str(state["error"])
+                raise state["error"]
+            outcome = "completed"
+        finally:
+            reader.cancel()
+            await asyncio.gather(reader, return_exceptions=True)
+            self._active.pop(id(record), None)
+            self._recent.append(record)
+            self.stats[outcome] += 1
+            self.stats["bytes"] += record.bytes
+            self.stats["stall_ms_total"] += record.stall_ms
+            if record.ttfb_ms is not None:
+                self.stats["first_bytes"] += 1
+                self.stats["ttfb_ms_total"] += record.ttfb_ms
+
+    def get_stats(self) -> Dict[str, Any]:
+        first_bytes = self.stats["first_bytes"]
+        return {
+            **self.stats,
+            "active": [r.to_dict() for r in self._active.values()],
+            "ttfb_ms_avg": round(self.stats["ttfb_ms_total"] / first_bytes, 1) if first_bytes else None,
+            "recent": [r.to_dict() for r in self._recent],
+        }
+
+stream_pipeline = StreamPipeline()
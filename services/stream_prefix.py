@@ -0,0 +1,176 @@
+import asyncio
+import os
+from collections import OrderedDict
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional
+from services.stream_cache import stream_cache
+from services.extraction_engine import PRIORITY_PREWARM
+from services.segment_cache import segment_cache, SEGMENT_SIZE
+from services.stream_fanout import stream_fanout
+from services.stream_upstream import stream_upstream
+from services.youtube import StreamInfo
+
+# Leading bytes held per track; one segment, so the fetch also fills segment 0 on disk
+PREFIX_BYTES = SEGMENT_SIZE
+# Memory this process spends on prefixes before evicting least recently used ones
+PREFIX_CACHE_MAX_BYTES = int(os.getenv("PREFIX_CACHE_MAX_MB", "32")) * 1024 * 1024
+PREFIX_CONCURRENCY = int(os.getenv("PREFIX_CONCURRENCY", "2"))
+PREFIX_MAX_PENDING = 50
+
+class _Prefix:
+    __slots__ = ("itag", "content_length", "data")
+
+    def __init__(self, itag, content_length: int, data: bytes):
+        self.itag = itag
+        self.content_length = content_length
+        self.data = data
+
+class PrefixCache:
+    """
+    Holds the first PREFIX_BYTES of the tracks most likely to play next (top
+    search hits, autoplay candidates) in memory, so /stream can answer with
+    audio before any upstream connection is open and splice the rest in behind.
+
+    Prefixes are fetched through the segment cache, so the same bytes also land
+    on disk for the other workers. A prefix is only used while the cached
+    stream still has the itag and length it was fetched for.
+    """
+
+    def __init__(self, max_bytes: int = PREFIX_CACHE_MAX_BYTES, concurrency: int = PREFIX_CONCURRENCY):
+        self.max_bytes = max_bytes
+        self.concurrency = concurrency
+        self._entries: "OrderedDict[str, _Prefix]" = OrderedDict()
+        self._bytes = 0
+        # video_id -> group, in fetch order
+        self._pending: "OrderedDict[str, Optional[str]]" = OrderedDict()
+        self._groups: Dict[str, set] = {}
+        self._running: set = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+        self.stats = {"scheduled": 0, "superseded": 0, "fetched": 0, "failed": 0, "evictions": 0,
+                      "hits": 0, "misses": 0, "stale": 0, "bytes_served": 0}
+
+    def schedule(self, video_ids: Iterable[str], group: str = None):
+        """Queues prefix fetches in rank order. A new schedule for a group replaces its queued ones."""
+        video_ids = [v for v in video_ids if v]
+        if group is not None:
+            for old in self._groups.pop(group, set()) - set(video_ids):
+                if old in self._pending:
+                    del self._pending[old]
+                    self.stats["superseded"] += 1
+        for video_id in video_ids:
+            if video_id in self._entries or video_id in self._running or video_id in self._pending:
+                continue
+            if len(self._pending) >= PREFIX_MAX_PENDING:
+                break
+            self.stats["scheduled"] += 1
+            self._pending[video_id] = group
+            if group is not None:
+                self._groups.setdefault(group, set()).add(video_id)
+        if self._wakeup and self._pending:
+            self._wakeup.set()
+
+    def get(self, video_id: str, stream_info: StreamInfo) -> Optional[bytes]:
+        entry = self._entries.get(video_id)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        if (entry.itag, entry.content_length) != (stream_info.itag, stream_info.content_length):
+            # The stream now resolves to a different format
+            self.stats["stale"] += 1
+            self._remove(video_id)
+            return None
+        self.stats["hits"] += 1
+        self._entries.move_to_end(video_id)
+        return entry.data
+
+    def _remove(self, video_id: str):
+        entry = self._entries.pop(video_id, None)
+        if entry is not None:
+            self._bytes -= len(entry.data)
+
+    def _store(self, video_id: str, entry: _Prefix):
+        self._remove(video_id)
+        self._entries[video_id] = entry
+        self._bytes += len(entry.data)
+        while self._bytes > self.max_bytes and self._entries:
+            _, old = self._entries.popitem(last=False)
+            self._bytes -= len(old.data)
+            self.stats["evictions"] += 1
+
+    async def splice(self, prefix: bytes, start: int, end: int,
+                     continuation: Callable[[int], AsyncIterator[bytes]]) -> AsyncIterator[bytes]:
+        """Yields bytes [start, end] from the prefix, then from continuation(len(prefix)) onwards."""
+        self.stats["bytes_served"] += min(end + 1, len(prefix)) - start
+        yield memoryview(prefix)[start:end + 1]
+        if end >= len(prefix):
+            async for chunk in continuation(len(prefix)):
+                yield chunk
+
+    async def _fetch(self, video_id: str) -> bool:
+        info = await stream_cache.get(video_id, track=False)
+        if not info:
+            info = await stream_cache.extract(video_id, priority=PRIORITY_PREWARM)
+            if not info:
+                return False
+        if not info.content_length:
+            info = await stream_upstream.probe_metadata(video_id, info)
+            if not info.content_length:
+                return False
+        total = info.content_length
+        key = segment_cache.key(video_id, info.itag, total)
+        fetch = stream_fanout.fetcher(key, stream_upstream.fetcher(video_id, info))
+        data = bytearray()
+        async for chunk in segment_cache.serve(key, 0, min(PREFIX_BYTES, total) - 1, total, fetch):
+            data += chunk
+        self._store(video_id, _Prefix(info.itag, total, bytes(data)))
+        return True
+
+    def _next(self) -> Optional[str]:
+        if not self._pending:
+            return None
+        video_id, group = self._pending.popitem(last=False)
+        if group is not None and group in self._groups:
+            self._groups[group].discard(video_id)
+            if not self._groups[group]:
+                del self._groups[group]
+        return video_id
+
+    async def _worker(self):
+        while True:
+            video_id = self._next()
+            if video_id is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            self._running.add(video_id)
+            try:
+                if await self._fetch(video_id):
+                    self.stats["fetched"] += 1
+                else:
+                    self.stats["failed"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"Prefix fetch failed for {video_id}: {e}")
+            finally:
+                self._running.discard(video_id)
+
+    def start(self):
+        if self._workers:
+            return
+        self._wakeup = asyncio.Event()
+        if self._pending:
+            self._wakeup.set()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def get_stats(self) -> Dict[str, int]:
+        return {**self.stats, "entries": len(self._entries), "bytes": self._bytes, "pending": len(self._pending)}
+
+stream_prefix = PrefixCache()
@@ -0,0 +1,157 @@
+import asyncio
+import os
+import re
+import time
+from typing import AsyncIterator, Callable, Dict
+import httpx
+from services.youtube import StreamInfo
+from services.stream_cache import stream_cache
+from services.http_pool import http_pool
+
+UPSTREAM_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36"
+UPSTREAM_CHUNK_SIZE = 32 * 1024
+# Reconnects allowed per upstream read before the client's stream is given up
+STREAM_RESUME_RETRIES = int(os.getenv("STREAM_RESUME_RETRIES", "3"))
+STREAM_RESUME_BACKOFF = 0.25
+
+CONTENT_RANGE_TOTAL = re.compile(r"/(\d+)$")
+
+Fetcher = Callable[[int, int], AsyncIterator[bytes]]
+
+class StreamChanged(Exception):
+    """A fresh extraction returned a different byte stream; offsets no longer line up."""
+
+class UpstreamUnavailable(IOError):
+    pass
+
+def capture_stream_metadata(stream_info: StreamInfo, response) -> bool:
+    """Fills in missing mime/length from an upstream response. Returns True if anything changed."""
+    changed = False
+    if not stream_info.mime_type and response.headers.get("Content-Type"):
+        stream_info.mime_type = response.headers["Content-Type"].split(";")[0].strip()
+        changed = True
+    if not stream_info.content_length:
+        m = CONTENT_RANGE_TOTAL.search(response.headers.get("Content-Range", ""))
+        if m:
+            stream_info.content_length = int(m.group(1))
+            changed = True
+        elif response.status_code == 200 and response.headers.get("Content-Length"):
+            stream_info.content_length = int(response.headers["Content-Length"])
+            changed = True
+    return changed
+
+class StreamUpstream:
+    """
+    Ranged GETs against googlevideo for the stream proxy.
+
+    Reads resume transparently: the bytes delivered so far are tracked, and on a
+    connection error, premature end or expired URL the read is reopened at the
+    exact offset with a Range header, using a URL refreshed by another worker
+    if there is one and re-extracting otherwise.
+    """
+
+    def __init__(self):
+        self.stats = {"reads": 0, "resumes": 0, "resume_failures": 0, "stream_changes": 0,
+                      "resume_ms_total": 0.0, "resume_ms_max": 0.0}
+
+    def _same_stream(self, a: StreamInfo, b: StreamInfo) -> bool:
+        return (a.itag, a.content_length) == (b.itag, b.content_length)
+
+    async def _replacement(self, video_id: str, current: StreamInfo) -> StreamInfo:
+        """A different, still-valid URL for the same byte stream."""
+        cached = await stream_cache.get(video_id, track=False)
+        if cached and cached.url != current.url and self._same_stream(cached, current):
+            return cached
+        fresh = await stream_cache.extract(video_id)
+        if not fresh:
+            raise UpstreamUnavailable(f"re-extraction failed for {video_id}")
+        if not self._same_stream(fresh, current):
+            self.stats["stream_changes"] += 1
+            raise StreamChanged(f"{video_id} now resolves to itag {fresh.itag}")
+        return fresh
+
+    async def _open(self, stream_info: StreamInfo, start: int, end: int) -> httpx.Response:
+        req = http_pool.build_request("GET", stream_info.url, headers={
+            "User-Agent": UPSTREAM_USER_AGENT,
+            "Range": f"bytes={start}-{end}",
+        })
+        response = await http_pool.send(req, stream=True)
+        if response.status_code == 206 or (response.status_code == 200 and start == 0):
+            return response
+        await response.aclose()
+        raise UpstreamUnavailable(f"upstream returned {response.status_code} for bytes {start}-{end}")
+
+    def fetcher(self, video_id: str, stream_info: StreamInfo) -> Fetcher:
+        """fetch(start, end) over the stream's bytes, resuming on upstream failures."""
+        current = {"info": stream_info}
+
+        async def fetch(start: int, end: int) -> AsyncIterator[bytes]:
+            self.stats["reads"] += 1
+            pos = start
+            retries = 0
+            failed_at = None
+            while pos <= end:
+                try:
+                    response = await self._open(current["info"], pos, end)
+                    if capture_stream_metadata(current["info"], response):
+                        await stream_cache.set(video_id, current["info"])
+                    try:
+                        async for chunk in response.aiter_bytes(chunk_size=UPSTREAM_CHUNK_SIZE):
+                            if failed_at is not None:
+                                elapsed = (time.monotonic() - failed_at) * 1000
+                                self.stats["resume_ms_total"] += elapsed
+                                self.stats["resume_ms_max"] = max(self.stats["resume_ms_max"], elapsed)
+                                failed_at = None
+                            if len(chunk) > end + 1 - pos:
+                                # A 200 carries the whole file (or a server overshot the range): stop at end
+                                chunk = chunk[:end + 1 - pos]
+                            pos += len(chunk)
+                            yield chunk
+                            if pos > end:
+                                break
+                    finally:
+                        await response.aclose()
+                    if pos <= end:
+                        raise UpstreamUnavailable(f"upstream closed at byte {pos}, expected {end + 1}")
+                except (httpx.HTTPError, OSError) as e:
+                    if retries >= STREAM_RESUME_RETRIES:
+                        self.stats["resume_failures"] += 1
+                        raise
+                    retries += 1
+                    self.stats["resumes"] += 1
+                    if failed_at is None:
+                        failed_at = time.monotonic()
+                    print(f"Upstream read for {video_id} failed at byte {pos} ({e}); resuming")
+                    await asyncio.sleep(STREAM_RESUME_BACKOFF * retries)
+                    current["info"] = await self._replacement(video_id, current["info"])
+
+        return fetch
+
+    async def probe_metadata(self, video_id: str, stream_info: StreamInfo) -> StreamInfo:
+        """Lazy upstream probe (a one-byte ranged GET) for streams cached without mime/length."""
+        for attempt in range(2):
+            async with http_pool.stream("GET", stream_info.url, timeout=5, headers={
+                "User-Agent": UPSTREAM_USER_AGENT,
+                "Range": "bytes=0-0",
+            }) as r:
+                if r.status_code == 403 and attempt == 0:
+                    fresh = await stream_cache.extract(video_id)
+                    if not fresh:
+                        break
+                    stream_info = fresh
+                    if stream_info.content_length and stream_info.mime_type:
+                        return stream_info
+                    continue
+                if capture_stream_metadata(stream_info, r):
+                    await stream_cache.set(video_id, stream_info)
+                break
+        return stream_info
+
+    def get_stats(self) -> Dict[str, float]:
+        resumes = self.stats["resumes"]
+        return {
+            **self.stats,
+            "resume_ms_avg": round(self.stats["resume_ms_total"] / resumes, 1) if resumes else None,
+        }
+
+stream_upstream = StreamUpstream()
@@ -0,0 +1,176 @@
+import asyncio
+import os
+import shutil
+from typing import AsyncIterator, Callable, Dict, Optional
+from services.cache import redis_client
+from services.segment_cache import segment_cache
+
+# ?quality= values and their Opus bitrates in kbps
+TRANSCODE_QUALITIES = {"low": 48, "medium": 96}
+TRANSCODE_MIME = "audio/ogg"
+# ffmpeg processes this web worker runs at once
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", "2"))
+# Requests allowed to queue for a slot; beyond that the original stream is served
+TRANSCODE_MAX_WAITING = TRANSCODE_WORKERS * 2
+# How long the encoded length of a finished transcode is remembered
+TRANSCODE_META_TTL = 86400
+TRANSCODE_READ_SIZE = 64 * 1024
+# The first encode's length isn't known until it ends, so it is fetched as [0, TRANSCODE_OPEN_END]
+TRANSCODE_OPEN_END = 2 ** 62
+
+FFMPEG = shutil.which("ffmpeg")
+
+class Transcoder:
+    """
+    Re-encodes upstream audio to low-bitrate Opus through ffmpeg.
+
+    The first request for a (stream, bitrate) pair is encoded live and written
+    to the segment cache as it goes; once it completes, its length is stored in
+    Redis and later requests are served from the segment cache with ranges like
+    the original. The encode is bit-exact, so segments evicted since can be
+    refilled by encoding again and skipping to the wanted offset. Callers wrap
+    fetcher() in the stream fan-out, so concurrent requests for the same key
+    share one ffmpeg process.
+
+    A semaphore caps the ffmpeg processes per worker so transcoding can't
+    oversubscribe the CPU; when too many requests are already waiting the
+    caller serves the original stream instead.
+    """
+
+    def __init__(self, redis, workers: int = TRANSCODE_WORKERS, max_waiting: int = TRANSCODE_MAX_WAITING):
+        self.redis = redis
+        self.workers = workers
+        self.max_waiting = max_waiting
+        self._slots = asyncio.Semaphore(workers)
+        self._active = 0
+        self._waiting = 0
+        self.stats = {"encodes": 0, "completed": 0, "failed": 0, "bytes_in": 0, "bytes_out": 0,
+                      "cached_serves": 0, "refills": 0, "fallbacks": 0}
+
+    @property
+    def available(self) -> bool:
+        return FFMPEG is not None
+
+    def saturated(self) -> bool:
+        if self._waiting >= self.max_waiting:
+            self.stats["fallbacks"] += 1
+            return True
+        return False
+
+    def key(self, source_key: str, kbps: int) -> str:
+        return f"{source_key}-opus{kbps}"
+
+    def _meta_key(self, key: str) -> str:
+        return f"transcode:{key}"
+
+    async def cached_length(self, key: str) -> Optional[int]:
+        """Length of a finished encode, or None if it hasn't completed yet."""
+        total = await self.redis.get(self._meta_key(key))
+        if total:
+            self.stats["cached_serves"] += 1
+            return int(total)
+        return None
+
+    def _command(self, kbps: int):
+        return [
+            FFMPEG, "-hide_banner", "-loglevel", "error", "-nostdin",
+            "-i", "pipe:0", "-vn", "-map_metadata", "-1",
+            "-c:a", "libopus", "-b:a", f"{kbps}k",
+            # Deterministic output (fixed Ogg serial, no encoder tag) so a re-encode lines up byte for byte
+            "-fflags", "+bitexact", "-flags:a", "+bitexact",
+            "-f", "ogg", "pipe:1",
+        ]
+
+    async def encode(self, source: AsyncIterator[bytes], kbps: int) -> AsyncIterator[bytes]:
+        """Yields source re-encoded at kbps, once a transcoder slot is free."""
+        self._waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+        self._active += 1
+        self.stats["encodes"] += 1
+        proc = None
+        feeder = None
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *self._command(kbps),
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+
+            async def feed():
+                try:
+                    async for chunk in source:
+                        self.stats["bytes_in"] += len(chunk)
+                        proc.stdin.write(chunk)
+                        await proc.stdin.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    # ffmpeg exited; its return code tells the reader why
+                    pass
+                finally:
+                    await source.aclose()
+                    if not proc.stdin.is_closing():
+                        proc.stdin.close()
+
+            feeder = asyncio.create_task(feed())
+            while True:
+                data = await proc.stdout.read(TRANSCODE_READ_SIZE)
+                if not data:
+                    break
+                self.stats["bytes_out"] += len(data)
+                yield data
+                if feeder.done() and feeder.exception() is not None:
+                    break
+            # Surfaces upstream errors from the feeder
+            await feeder
+            if await proc.wait() != 0:
+                err = (await proc.stderr.read()).decode(errors="replace").strip()
+                raise IOError(f"ffmpeg exited with {proc.returncode}: {err[-200:]}")
+            self.stats["completed"] += 1
+        except Exception:
+            self.stats["failed"] += 1
+            raise
+        finally:
+            if feeder is not None and not feeder.done():
+                feeder.cancel()
+                await asyncio.gather(feeder, return_exceptions=True)
+            if proc is not None and proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            self._active -= 1
+            self._slots.release()
+
+    def fetcher(self, key: str, open_source: Callable[[], AsyncIterator[bytes]], kbps: int):
+        """
+        fetch(start, end) over the encoded stream: encodes from the beginning of
+        the source and skips ahead to start. The open-ended fetch from 0 is the
+        first encode; it is recorded to the segment cache, and its length to
+        Redis once it completes.
+        """
+        async def fetch(start: int, end: int) -> AsyncIterator[bytes]:
+            live = start == 0 and end == TRANSCODE_OPEN_END
+            if not live:
+                self.stats["refills"] += 1
+            pos = 0
+            raw = self.encode(open_source(), kbps)
+            encoded = segment_cache.record(key, raw) if live else raw
+            try:
+                async for chunk in encoded:
+                    lo = max(start, pos) - pos
+                    hi = min(end + 1, pos + len(chunk)) - pos
+                    pos += len(chunk)
+                    if hi > lo:
+                        yield chunk if hi - lo == len(chunk) else memoryview(chunk)[lo:hi]
+                    if pos > end:
+                        break
+            finally:
+                await encoded.aclose()
+                if encoded is not raw:
+                    await raw.aclose()
+            if live:
+                await self.redis.setex(self._meta_key(key), TRANSCODE_META_TTL, str(pos))
+        return fetch
+
+    def get_stats(self) -> Dict[str, int]:
+        return {**self.stats, "available": self.available, "active": self._active, "waiting": self._waiting}
+
+transcoder = Transcoder(redis_client)
@@ -1,5 +1,42 @@
 import re
-from typing import Dict, Any
+from typing import Dict, Any, List, Set
+
+NON_ALNUM = re.compile(r'[^a-z0-9\s]')
+
+class KeywordMatcher:
+    """Finds every keyword (as a substring) occurring in a text with a single regex pass."""
+
+    def __init__(self, keywords: List[str]):
+        # Longest first, so the alternation reports the longest keyword starting at each position
+        self.keywords = sorted(set(keywords), key=len, reverse=True)
+        self.pattern = re.compile("(?=(" + "|".join(re.escape(k) for k in self.keywords) + "))")
+        # A shorter keyword at the same position is contained in the reported one
+        self.implied = {k: frozenset(o for o in self.keywords if o in k) for k in self.keywords}
+
+    def find(self, text: str) -> Set[str]:
+        found = set()
+        for m in self.pattern.finditer(text):
+            found |= self.implied[m.group(1)]
+        return found
+
+class QueryInfo:
+    __slots__ = ("norm", "tokens", "keywords", "bypass")
+
+    def __init__(self, norm: str, tokens: List[str], keywords: Set[str], bypass: bool):
+        self.norm = norm
+        self.tokens = tokens
+        self.keywords = keywords
+        self.bypass = bypass
+
+class EntryScore:
+    __slots__ = ("title_norm", "channel_norm", "spam", "trust", "match")
+
+    def __init__(self, title_norm: str, channel_norm: str, spam: bool, trust: int, match: int):
+        self.title_norm = title_norm
+        self.channel_norm = channel_norm
+        self.spam = spam
+        self.trust = trust
+        self.match = match
 
 class TrustedChannels:
     def __init__(self):
@@ -9,45 +46,78 @@ class TrustedChannels:
                               "reaction", "review", "status", "whatsapp", "tiktok", "reels", "shorts",
                               "episode", "full movie", "teaser", "breaking", "debate", "sport", 
                               "highlights", "gaming", "gameplay", "tutorial", "howto", "unboxing"]
+        # If user explicitly asked for these, don't filter them out
+        self.bypass_keywords = ["news", "trailer", "interview", "gaming", "debate", "highlights"]
+
+        self._spam = frozenset(self.spam_keywords)
+        self._bypass = frozenset(self.bypass_keywords)
+        self._trusted = frozenset(self.trusted_keywords)
+        self._premium = frozenset(["topic", "vevo"])
+        # One matcher for every keyword family, so each text is scanned once
+        self.matcher = KeywordMatcher(self.spam_keywords + self.bypass_keywords + self.trusted_keywords)
 
     def normalize(self, text: str) -> str:
         if not text: return ""
-        text = text.lower()
-        text = re.sub(r'[^a-z0-9\s]', '', text)
-        return text.strip()
+        return NON_ALNUM.sub('', text.lower()).strip()
 
-    def is_spam(self, title: str, query: str) -> bool:
-        title_norm = self.normalize(title)
-        query_norm = self.normalize(query)
-        
-        # If user explicitly asked for these, don't filter them out
-        bypass_keywords = ["news", "trailer", "interview", "gaming", "debate", "highlights"]
-        if any(bw in query_norm for bw in bypass_keywords):
+    def analyze_query(self, query: str) -> QueryInfo:
+        norm = self.normalize(query)
+        keywords = self.matcher.find(norm)
+        return QueryInfo(norm, norm.split(), keywords, bool(keywords & self._bypass))
+
+    def _is_spam(self, title_keywords: Set[str], q: QueryInfo) -> bool:
+        if q.bypass:
             return False
-            
-        for word in self.spam_keywords:
-            if word in title_norm:
-                # If the spam word is NOT in the user query, it's likely unwanted
-                if word not in query_norm:
-                    return True
-        return False
+        # A spam word in the title that is NOT in the user query is likely unwanted
+        return bool((title_keywords & self._spam) - q.keywords)
 
-    def calculate_trust_score(self, channel: str, title: str) -> int:
+    def _trust_score(self, channel_keywords: Set[str], title_keywords: Set[str]) -> int:
         score = 0
-        channel_norm = self.normalize(channel)
-        title_norm = self.normalize(title)
-        
-        if "topic" in channel_norm or "vevo" in channel_norm:
+        if channel_keywords & self._premium:
             score += 100
-        
-        if any(word in channel_norm for word in self.trusted_keywords):
+        if channel_keywords & self._trusted:
             score += 40
-            
-        if "official" in title_norm:
+        if "official" in title_keywords:
             score += 30
-            
         return score
 
+    def _match_score(self, q: QueryInfo, title_norm: str) -> int:
+        score = 0
+        for token in q.tokens:
+            if token in title_norm:
+                score += 15
+        if q.norm in title_norm: score += 20
+        return score
+
+    def score_entries(self, entries: List[Dict[str, Any]], query: str) -> List[EntryScore]:
+        """
+        Scores a whole batch of search entries against one query.
+        Every title, channel and the query are normalized and scanned exactly once.
+        """
+        q = self.analyze_query(query)
+        scores = []
+        for entry in entries:
+            title_norm = self.normalize(entry.get('title'))
+            channel_norm = self.normalize(entry.get('uploader'))
+            title_keywords = self.matcher.find(title_norm)
+            channel_keywords = self.matcher.find(channel_norm)
+            scores.append(EntryScore(
+                title_norm,
+                channel_norm,
+                self._is_spam(title_keywords, q),
+                self._trust_score(channel_keywords, title_keywords),
+                self._match_score(q, title_norm),
+            ))
+        return scores
+
+    def is_spam(self, title: str, query: str) -> bool:
+        title_keywords = self.matcher.find(self.normalize(title))
+        return self._is_spam(title_keywords, self.analyze_query(query))
+
+    def calculate_trust_score(self, channel: str, title: str) -> int:
+        return self._trust_score(self.matcher.find(self.normalize(channel)),
+                                 self.matcher.find(self.normalize(title)))
+
     async def get_ai_trust_score(self, channel: str, recent_titles: list) -> int:
         """Leverages AI classifier for a more semantic trust score."""
         from services.ai_classifier import ai_classifier
@@ -0,0 +1,214 @@
+import asyncio
+import os
+import time
+from collections import Counter, OrderedDict, deque
+from typing import Any, Dict, List, Optional, Tuple
+from services.cache import redis_client
+from services.codec import redis_codec
+from services.firebase_db import firebase_db
+from services.singleflight import SingleFlight
+from services.trusted_channels import trusted_channels
+
+# Active users whose profile this process keeps
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "256"))
+# Seconds a worker serves its own copy; bounds staleness for changes clients write to Firebase directly
+PROFILE_LOCAL_TTL = float(os.getenv("PROFILE_LOCAL_TTL", "60"))
+# Seconds the shared copy lives; with the local TTL, bounds how late a like written by a client shows up
+PROFILE_REDIS_TTL = int(os.getenv("PROFILE_REDIS_TTL", "120"))
+# Plays kept per profile
+PROFILE_HISTORY = 100
+# Most played artists read from the per-artist play counters
+PROFILE_TOP_ARTISTS = 30
+PROFILE_KEY_PREFIX = "profile:"
+
+class UserProfile:
+    """A user's taste data: liked songs and artists, recent plays and most played artists."""
+
+    __slots__ = ("user_id", "likes", "history", "liked_artists", "history_artists", "artist_plays")
+
+    def __init__(self, user_id: str, likes: Dict[str, List] = None, history: List[Dict] = None,
+                 artist_plays: Dict[str, int] = None):
+        self.user_id = user_id
+        # like key -> [song id, artist]
+        self.likes: Dict[str, List] = {}
+        self.history: deque = deque(maxlen=PROFILE_HISTORY)
+        # normalized liked artist -> number of liked songs by them
+        self.liked_artists: Counter = Counter()
+        self.history_artists: Counter = Counter()
+        # Top artists by plays recorded through the backend (artist_plays counters in Firebase)
+        self.artist_plays: Counter = Counter(artist_plays or {})
+        self.replace_likes(likes or {})
+        for item in history or []:
+            self.add_play(item)
+
+    @staticmethod
+    def like_entry(song) -> List:
+        if not isinstance(song, dict):
+            return [str(song), None]
+        return [song.get("id") or song.get("video_id"), song.get("artist")]
+
+    @staticmethod
+    def history_entry(item) -> Dict:
+        if not isinstance(item, dict):
+            return {"video_id": str(item)}
+        return {k: item[k] for k in ("song_id", "video_id", "title", "artist", "timestamp") if k in item}
+
+    def replace_likes(self, likes: Dict[str, List]):
+        self.likes = {}
+        self.liked_artists = Counter()
+        for key, entry in likes.items():
+            self.set_like(key, entry)
+
+    def set_like(self, key: str, entry: Optional[List]):
+        old = self.likes.pop(key, None)
+        if old and old[1]:
+            artist = trusted_channels.normalize(old[1])
+            self.liked_artists[artist] -= 1
+            if self.liked_artists[artist] <= 0:
+                del self.liked_artists[artist]
+        if entry is not None:
+            self.likes[key] = entry
+            if entry[1]:
+                self.liked_artists[trusted_channels.normalize(entry[1])] += 1
+
+    def add_play(self, item: Dict):
+        if len(self.history) == self.history.maxlen:
+            dropped = self.history[0].get("artist")
+            if dropped:
+                self.history_artists[dropped] -= 1
+                if self.history_artists[dropped] <= 0:
+                    del self.history_artists[dropped]
+        self.history.append(item)
+        if item.get("artist"):
+            self.history_artists[item["artist"]] += 1
+
+    def liked_ids(self) -> set:
+        return {entry[0] for entry in self.likes.values() if entry[0]}
+
+    def frequent_artists(self, limit: int = 10) -> List[str]:
+        # Counters only cover plays recorded through POST /history/record (clients writing
+        # play_history directly aren't counted), so they add to recent history
+        counts = self.history_artists + self.artist_plays
+        return [artist for artist, _ in counts.most_common(limit)]
+
+    def recent_history(self, limit: int = 50) -> List[Dict]:
+        return list(self.history)[-limit:]
+
+    def dumps(self) -> str:
+        return redis_codec.encode({"likes": self.likes, "history": list(self.history),
+                                   "artist_plays": dict(self.artist_plays)})
+
+    @classmethod
+    def loads(cls, user_id: str, raw: Optional[str]) -> Optional["UserProfile"]:
+        if not raw:
+            return None
+        data = redis_codec.decode(raw)
+        return cls(user_id, data.get("likes"), data.get("history"), data.get("artist_plays"))
+
+class ProfileCache:
+    """
+    Per-process LRU of UserProfile records for active users, backed by Redis.
+
+    A profile is built once from Firebase (likes, recent history and the
+    per-artist play counters read concurrently) and shared with the other workers through Redis. Writes and
+    deletes of profile keys publish an invalidation (SafeRedis.watch), so the
+    other workers drop their copy and reload it from Redis rather than
+    Firebase. Changes clients write to Firebase directly (likes) show up once
+    the local and Redis copies expire, within PROFILE_LOCAL_TTL +
+    PROFILE_REDIS_TTL, or right away after invalidate(). Plays recorded through
+    the backend are applied in place by record_play().
+    """
+
+    def __init__(self, max_users: int = PROFILE_CACHE_SIZE):
+        self.max_users = max_users
+        # user id -> (profile, monotonic time it was loaded)
+        self._profiles: "OrderedDict[str, Tuple[UserProfile, float]]" = OrderedDict()
+        # Bumped on every invalidation, so a load that raced one isn't kept
+        self._generation = 0
+        self.flight = SingleFlight("profile")
+        self.stats = {"local_hits": 0, "redis_hits": 0, "builds": 0, "invalidations": 0,
+                      "remote_invalidations": 0, "evictions": 0}
+        redis_client.watch(PROFILE_KEY_PREFIX, self._on_invalidation)
+
+    def key(self, user_id: str) -> str:
+        return f"{PROFILE_KEY_PREFIX}{user_id}"
+
+    async def get(self, user_id: str) -> Optional[UserProfile]:
+        if not user_id or user_id == "guest":
+            return None
+        entry = self._profiles.get(user_id)
+        if entry is not None and time.monotonic() - entry[1] < PROFILE_LOCAL_TTL:
+            self.stats["local_hits"] += 1
+            self._profiles.move_to_end(user_id)
+            return entry[0]
+        return await self.flight.do(user_id, lambda: self._load(user_id))
+
+    async def _load(self, user_id: str) -> UserProfile:
+        generation = self._generation
+        profile = UserProfile.loads(user_id, await redis_client.get(self.key(user_id)))
+        if profile is not None:
+            self.stats["redis_hits"] += 1
+        else:
+            self.stats["builds"] += 1
+            likes, history, artist_plays = await asyncio.gather(
+                firebase_db.read(f"likes/{user_id}"),
+                firebase_db.get_play_history(user_id, limit=PROFILE_HISTORY),
+                firebase_db.get_artist_plays(user_id, limit=PROFILE_TOP_ARTISTS),
+            )
+            if isinstance(likes, list):
+                likes = {str(i): song for i, song in enumerate(likes) if song}
+            profile = UserProfile(
+                user_id,
+                {key: UserProfile.like_entry(song) for key, song in (likes or {}).items()},
+                [UserProfile.history_entry(item) for item in history],
+                artist_plays,
+            )
+            if generation == self._generation:
+                await redis_client.setex(self.key(user_id), PROFILE_REDIS_TTL, profile.dumps())
+        if generation == self._generation:
+            self._remember(user_id, profile)
+        return profile
+
+    def _remember(self, user_id: str, profile: UserProfile):
+        self._profiles[user_id] = (profile, time.monotonic())
+        self._profiles.move_to_end(user_id)
+        while len(self._profiles) > self.max_users:
+            self._profiles.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _on_invalidation(self, key: Optional[str]):
+        """Another worker changed a profile (or invalidations were missed: key is None)."""
+        self._generation += 1
+        self.stats["remote_invalidations"] += 1
+        if key is None:
+            self._profiles.clear()
+        else:
+            self._profiles.pop(key[len(PROFILE_KEY_PREFIX):], None)
+
+    async def record_play(self, user_id: str, song: Dict[str, Any]):
+        """Applies a play just written by FirebaseDB.record_play and shares the updated profile."""
+        entry = self._profiles.get(user_id)
+        if entry is None:
+            # Not loaded here: the next read rebuilds it, counters included
+            await self.invalidate(user_id)
+            return
+        profile = entry[0]
+        # A load that started before this play must not replace the updated copy
+        self._generation += 1
+        profile.add_play(UserProfile.history_entry(song))
+        artist = (song.get("artist") or "").strip()
+        if artist:
+            profile.artist_plays[artist] += 1
+        await redis_client.setex(self.key(user_id), PROFILE_REDIS_TTL, profile.dumps())
+
+    async def invalidate(self, user_id: str):
+        """Drops a profile from every worker and Redis so the next read rebuilds it from Firebase."""
+        self.stats["invalidations"] += 1
+        self._generation += 1
+        self._profiles.pop(user_id, None)
+        await redis_client.delete(self.key(user_id))
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "profiles": len(self._profiles)}
+
+profile_cache = ProfileCache()
@@ -0,0 +1,128 @@
+import yt_dlp
+import os
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+
+# Instances per option set, and how many extractions one instance may serve
+# before it is thrown away (a fresh session avoids YouTube flagging it)
+YDL_POOL_SIZE = int(os.getenv("YDL_POOL_SIZE", "2"))
+YDL_POOL_MAX_USES = int(os.getenv("YDL_POOL_MAX_USES", "20"))
+
+class _PooledYDL:
+    __slots__ = ("ydl", "uses")
+
+    def __init__(self, ydl):
+        self.ydl = ydl
+        self.uses = 0
+
+class YDLPool:
+    """
+    Bounded pool of pre-constructed yt_dlp.YoutubeDL instances, keyed by option set.
+    Checkout/checkin happens from executor threads, so it is guarded by a lock.
+    The pool bounds what is kept warm, not concurrency: when every instance is
+    checked out, the caller gets a one-off instance rather than waiting.
+    """
+
+    def __init__(self, size: int = YDL_POOL_SIZE, max_uses: int = YDL_POOL_MAX_USES):
+        self.size = size
+        self.max_uses = max_uses
+        self._lock = threading.Lock()
+        self._factories: Dict[str, Callable[[], dict]] = {}
+        self._warmers: Dict[str, List[str]] = {}
+        self._idle: Dict[str, List[_PooledYDL]] = {}
+        self._slots: Dict[str, threading.BoundedSemaphore] = {}
+        self.stats = {"created": 0, "reused": 0, "recycled": 0, "errors": 0, "overflow": 0}
+
+    def register(self, name: str, opts_factory: Callable[[], dict], warm_extractors: List[str] = None):
+        """Registers an option set. opts_factory is called for every new instance."""
+        with self._lock:
+            self._factories[name] = opts_factory
+            self._warmers[name] = warm_extractors or []
+            self._idle.setdefault(name, [])
+            self._slots.setdefault(name, threading.BoundedSemaphore(self.size))
+
+    def _build(self, name: str) -> _PooledYDL:
+        ydl = yt_dlp.YoutubeDL(self._factories[name]())
+        # Pay the cold costs up front: cookie jar load and extractor initialization
+        ydl.cookiejar
+        for ie_key in self._warmers[name]:
+            ydl.get_info_extractor(ie_key)
+        with self._lock:
+            self.stats["created"] += 1
+        return _PooledYDL(ydl)
+
+    def _discard(self, pooled: _PooledYDL):
+        try:
+            pooled.ydl.close()
+        except Exception as e:
+            print(f"Failed to close YoutubeDL instance: {e}")
+
+    @contextmanager
+    def checkout(self, name: str):
+        """Blocking checkout of a YoutubeDL instance; must be used off the event loop."""
+        slot = self._slots[name]
+        if not slot.acquire(blocking=False):
+            with self._lock:
+                self.stats["overflow"] += 1
+            extra = _PooledYDL(yt_dlp.YoutubeDL(self._factories[name]()))
+            try:
+                yield extra.ydl
+            except Exception:
+                with self._lock:
+                    self.stats["errors"] += 1
+                raise
+            finally:
+                self._discard(extra)
+            return
+        pooled = None
+        healthy = True
+        try:
+            with self._lock:
+                idle = self._idle[name]
+                if idle:
+                    pooled = idle.pop()
+                    self.stats["reused"] += 1
+            if pooled is None:
+                pooled = self._build(name)
+            yield pooled.ydl
+        except Exception:
+            healthy = False
+            with self._lock:
+                self.stats["errors"] += 1
+            raise
+        finally:
+            if pooled is not None:
+                pooled.uses += 1
+                keep = False
+                if healthy and pooled.uses < self.max_uses:
+                    with self._lock:
+                        if len(self._idle[name]) < self.size:
+                            self._idle[name].append(pooled)
+                            keep = True
+                if not keep:
+                    with self._lock:
+                        self.stats["recycled"] += 1
+                    self._discard(pooled)
+            slot.release()
+
+    def warm(self, names: List[str] = None, limit: int = None):
+        """Fills the pool for the given option sets (all by default), up to limit instances each. Blocking."""
+        for name in names or list(self._factories):
+            while True:
+                with self._lock:
+                    if len(self._idle[name]) >= min(self.size, limit or self.size):
+                        break
+                try:
+                    pooled = self._build(name)
+                except Exception as e:
+                    print(f"Failed to warm YoutubeDL pool '{name}': {e}")
+                    break
+                with self._lock:
+                    self._idle[name].append(pooled)
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self.stats, "idle": {name: len(idle) for name, idle in self._idle.items()}}
+
+ydl_pool = YDLPool()
@@ -1,7 +1,108 @@
-import yt_dlp
 import os
+import re
+import json
 import asyncio
 from asyncio import Semaphore
+from typing import Any, Dict, Optional
+from urllib.parse import urlparse, parse_qs
+from services.ydl_pool import ydl_pool
+from services.extraction_engine import extraction_engine, PRIORITY_INTERACTIVE
+
+EXPIRE_IN_PATH = re.compile(r"/expire/(\d+)")
+EXT_MIME_TYPES = {"webm": "audio/webm", "m4a": "audio/mp4", "mp4": "audio/mp4", "mp3": "audio/mpeg", "opus": "audio/ogg"}
+
+def _url_params(url: str) -> Dict[str, str]:
+    try:
+        return {k: v[0] for k, v in parse_qs(urlparse(url).query).items()}
+    except ValueError:
+        return {}
+
+def _to_int(value) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def parse_expiry(url: str) -> Optional[int]:
+    """Returns the unix expiry of a googlevideo URL (expire= query param or /expire/ path segment)."""
+    if not url:
+        return None
+    expire = _to_int(_url_params(url).get("expire"))
+    if expire is not None:
+        return expire
+    m = EXPIRE_IN_PATH.search(urlparse(url).path)
+    return int(m.group(1)) if m else None
+
+class StreamInfo:
+    """
+    Compact result of a stream extraction. The full yt-dlp info dict (every format,
+    thumbnails, subtitles...) never leaves the extraction worker.
+    """
+    __slots__ = ("url", "mime_type", "content_length", "itag", "bitrate", "duration",
+                 "expires_at", "title", "formats_count")
+
+    def __init__(self, url: str, mime_type: str = None, content_length: int = None, itag: int = None,
+                 bitrate: float = None, duration: float = None, expires_at: int = None,
+                 title: str = None, formats_count: int = 0):
+        self.url = url
+        self.mime_type = mime_type
+        self.content_length = content_length
+        self.itag = itag
+        self.bitrate = bitrate
+        self.duration = duration
+        self.expires_at = expires_at
+        self.title = title
+        self.formats_count = formats_count
+
+    @classmethod
+    def from_url(cls, url: str, **fields) -> "StreamInfo":
+        """googlevideo URLs carry mime, clen, itag, dur and expire as query params."""
+        params = _url_params(url)
+        mime = params.get("mime")
+        return cls(
+            url,
+            mime_type=fields.get("mime_type") or (mime.split(";")[0] if mime else None),
+            content_length=fields.get("content_length") or _to_int(params.get("clen")),
+            itag=fields.get("itag") or _to_int(params.get("itag")),
+            bitrate=fields.get("bitrate"),
+            duration=fields.get("duration") or (float(params["dur"]) if params.get("dur") else None),
+            expires_at=parse_expiry(url),
+            title=fields.get("title"),
+            formats_count=fields.get("formats_count", 0),
+        )
+
+    @classmethod
+    def from_info(cls, info: Dict[str, Any]) -> Optional["StreamInfo"]:
+        if not info or not info.get("url"):
+            return None
+        return cls.from_url(
+            info["url"],
+            mime_type=EXT_MIME_TYPES.get(info.get("ext")),
+            # Exact sizes only (it is served as Content-Length and keys the segment cache);
+            # otherwise clen from the URL or a later HEAD probe supplies it
+            content_length=_to_int(info.get("filesize")),
+            itag=_to_int(info.get("format_id")),
+            bitrate=info.get("abr") or info.get("tbr"),
+            duration=info.get("duration"),
+            title=info.get("title"),
+            formats_count=len(info.get("formats") or []),
+        )
+
+    def dumps(self) -> str:
+        """Compact positional encoding for Redis."""
+        return json.dumps([getattr(self, f) for f in self.__slots__], separators=(",", ":"))
+
+    @classmethod
+    def loads(cls, raw: str) -> Optional["StreamInfo"]:
+        if not raw:
+            return None
+        if raw.startswith("["):
+            return cls(*json.loads(raw))
+        # Entries cached before this format were the bare URL
+        return cls.from_url(raw)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {f: getattr(self, f) for f in self.__slots__}
 
 class YouTubeService:
     def __init__(self):
@@ -54,9 +155,13 @@ class YouTubeService:
             self.YDL_OPTS["cookiefile"] = os.path.join(current_dir, "cookies.txt")
             print(f"Loaded local cookies.txt")
         
-        # Limit parallel extractions to prevent OOM on Railway (512MB RAM)
+        # Limit parallel in-process extractions to prevent OOM on Railway (512MB RAM);
+        # only used when the extraction engine isn't running
         self.semaphore = Semaphore(2)
 
+        # Instances are reused and recycled after a few extractions by the pool
+        ydl_pool.register("audio", self.get_opts, warm_extractors=["Youtube"])
+
     def get_opts(self):
         opts = self.YDL_OPTS.copy()
         # Ensure fresh cookies are always used if file exists
@@ -65,23 +170,26 @@ class YouTubeService:
             opts["cookiefile"] = os.path.join(current_dir, "cookies_env.txt")
         return opts
 
-    async def get_stream_url(self, video_id: str):
-        # Throttle parallel extractions
-        async with self.semaphore:
-            try:
-                url = f"https://www.youtube.com/watch?v={video_id}"
+    def extract_blocking(self, video_id: str) -> Optional[StreamInfo]:
+        """Runs one full extraction in the calling thread/process and slims the result."""
+        url = f"https://www.youtube.com/watch?v={video_id}"
+        # Pooled instances are recycled after a few uses to avoid session flagging
+        with ydl_pool.checkout("audio") as ydl:
+            info = ydl.extract_info(url, download=False)
+        return StreamInfo.from_info(info)
+
+    async def get_stream_url(self, video_id: str, priority: int = PRIORITY_INTERACTIVE) -> Optional[StreamInfo]:
+        try:
+            # Normally runs in the extraction worker processes
+            if extraction_engine.running:
+                return await extraction_engine.submit(video_id, priority)
+
+            # Fallback when the engine isn't started (e.g. outside the app lifespan)
+            async with self.semaphore:
                 loop = asyncio.get_event_loop()
-                
-                # Use fresh instance for each request to avoid session flagging
-                opts = self.get_opts()
-                def extract():
-                    with yt_dlp.YoutubeDL(opts) as ydl:
-                        return ydl.extract_info(url, download=False)
-                
-                info = await loop.run_in_executor(None, extract)
-                return info
-            except Exception as e:
-                print(f"Error fetching stream info for {video_id}: {e}")
-                return None
+                return await loop.run_in_executor(None, self.extract_blocking, video_id)
+        except Exception as e:
+            print(f"Error fetching stream info for {video_id}: {e}")
+            return None
 
 yt_service = YouTubeService()
@@ -0,0 +1,89 @@
+import asyncio
+import os
+import tempfile
+import uuid
+import httpx
+import main
+from services.stream_cache import stream_cache
+from services.stream_pipeline import AudioStreamResponse, stream_pipeline
+from services.stream_upstream import stream_upstream
+from services.segment_cache import segment_cache
+from services.youtube import StreamInfo
+
+PAYLOAD = os.urandom(700 * 1024 + 123)
+
+async def fetch_stream(headers=None):
+    """GET /stream through the real app and its middleware, with upstream served from memory."""
+    video_id = uuid.uuid4().hex[:11]
+    info = StreamInfo("https://example.invalid/videoplayback", mime_type="audio/webm",
+                      content_length=len(PAYLOAD), itag=251)
+
+    async def get(vid):
+        return info if vid == video_id else None
+
+    def fetcher(vid, stream_info):
+        async def fetch(start, end):
+            for offset in range(start, end + 1, 64 * 1024):
+                yield PAYLOAD[offset:min(offset + 64 * 1024, end + 1)]
+        return fetch
+
+    stream_cache.get, stream_upstream.fetcher = get, fetcher
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await client.get(f"/stream/{video_id}", headers=headers or {})
+
+def run(coro):
+    original = (stream_cache.get, stream_upstream.fetcher, segment_cache.directory)
+    segment_cache.directory = tempfile.mkdtemp()
+    try:
+        return asyncio.run(coro)
+    finally:
+        stream_cache.get, stream_upstream.fetcher, segment_cache.directory = original
+
+def test_stream_full_body():
+    response = run(fetch_stream())
+    assert response.status_code == 200
+    assert response.headers["content-length"] == str(len(PAYLOAD))
+    assert response.content == PAYLOAD
+
+def test_stream_range():
+    response = run(fetch_stream({"Range": "bytes=300000-400000"}))
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 300000-400000/{len(PAYLOAD)}"
+    assert response.content == PAYLOAD[300000:400001]
+
+def test_stream_malformed_range_is_ignored():
+    response = run(fetch_stream({"Range": "bytes=abc"}))
+    assert response.status_code == 200
+    assert "content-range" not in response.headers
+    assert response.content == PAYLOAD
+
+def test_stream_unsatisfiable_range():
+    response = run(fetch_stream({"Range": f"bytes={len(PAYLOAD)}-"}))
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(PAYLOAD)}"
+
+def test_whole_chunks_are_sent_without_copying():
+    chunk = os.urandom(16 * 1024)
+
+    async def source():
+        # Past the fast-start window, pieces are sized to the client
+        yield os.urandom(64 * 1024)
+        yield chunk
+        yield memoryview(PAYLOAD)[:1000]
+
+    async def send_all():
+        bodies = []
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                bodies.append(message["body"])
+
+        response = AudioStreamResponse(stream_pipeline.pipe("test", source()), media_type="audio/webm")
+        await response.stream_response(send)
+        return bodies
+
+    bodies = asyncio.run(send_all())
+    assert all(type(body) is bytes for body in bodies)
+    assert any(body is chunk for body in bodies)
+    assert bodies[-2] == PAYLOAD[:1000]
@@ -0,0 +1,124 @@
+import asyncio
+import os
+from services.stream_fanout import StreamFanout
+
+PAYLOAD = os.urandom(700 * 1024)
+CHUNK = 16 * 1024
+
+def source(opened=None, delay=0.001):
+    """A fetch(start, end) over PAYLOAD that records the ranges it was opened with."""
+    async def fetch(start, end):
+        if opened is not None:
+            opened.append((start, end))
+        for offset in range(start, min(end + 1, len(PAYLOAD)), CHUNK):
+            await asyncio.sleep(delay)
+            yield PAYLOAD[offset:min(offset + CHUNK, end + 1)]
+    return fetch
+
+async def read(fetch, start, end, delay=0):
+    out = bytearray()
+    async for chunk in fetch(start, end):
+        out += chunk
+        if delay:
+            await asyncio.sleep(delay)
+    return bytes(out)
+
+async def read_after(fetch, start, end, wait):
+    await asyncio.sleep(wait)
+    return await read(fetch, start, end)
+
+def test_open_ended_listener_after_bounded_download():
+    async def scenario():
+        fanout = StreamFanout()
+        fetch = fanout.fetcher("k", source())
+        prefix, full = await asyncio.gather(
+            read(fetch, 0, 256 * 1024 - 1), read_after(fetch, 0, len(PAYLOAD) - 1, 0.005))
+        assert prefix == PAYLOAD[:256 * 1024]
+        assert full == PAYLOAD
+    asyncio.run(scenario())
+
+def test_concurrent_listeners_share_one_download():
+    async def scenario():
+        opened = []
+        fanout = StreamFanout()
+        fetch = fanout.fetcher("k", source(opened))
+        results = await asyncio.gather(*(read(fetch, 0, len(PAYLOAD) - 1) for _ in range(3)))
+        assert all(result == PAYLOAD for result in results)
+        assert opened == [(0, len(PAYLOAD) - 1)]
+        assert fanout.stats["joined"] == 2
+        assert fanout.get_stats()["active_upstreams"] == 0
+    asyncio.run(scenario())
+
+def test_late_listener_joins_from_the_ring_buffer():
+    async def scenario():
+        opened = []
+        fanout = StreamFanout()
+        fetch = fanout.fetcher("k", source(opened))
+        full, seek = await asyncio.gather(
+            read(fetch, 0, len(PAYLOAD) - 1), read_after(fetch, 100 * 1024, 500 * 1024, 0.01))
+        assert full == PAYLOAD
+        assert seek == PAYLOAD[100 * 1024:500 * 1024 + 1]
+        assert opened == [(0, len(PAYLOAD) - 1)]
+        assert fanout.stats["bytes_shared"] > 0
+    asyncio.run(scenario())
+
+def test_listener_past_the_download_end_opens_its_own():
+    async def scenario():
+        opened = []
+        fanout = StreamFanout()
+        fetch = fanout.fetcher("k", source(opened))
+        prefix, full = await asyncio.gather(
+            read(fetch, 0, 256 * 1024 - 1), read_after(fetch, 0, len(PAYLOAD) - 1, 0.005))
+        assert full == PAYLOAD
+        assert fanout.stats["joined"] == 0
+        assert sorted(opened) == [(0, 256 * 1024 - 1), (0, len(PAYLOAD) - 1)]
+    asyncio.run(scenario())
+
+def test_leaving_listener_does_not_stop_the_others():
+    async def scenario():
+        opened = []
+        fanout = StreamFanout()
+        fetch = fanout.fetcher("k", source(opened))
+
+        async def leave_early():
+            stream = fetch(0, len(PAYLOAD) - 1)
+            async for _ in stream:
+                break
+            await stream.aclose()
+
+        full, _ = await asyncio.gather(read(fetch, 0, len(PAYLOAD) - 1), leave_early())
+        assert full == PAYLOAD
+        assert opened == [(0, len(PAYLOAD) - 1)]
+    asyncio.run(scenario())
+
+def test_download_stops_when_every_listener_leaves():
+    async def scenario():
+        delivered = []
+
+        async def fetch(start, end):
+            for offset in range(start, end + 1, CHUNK):
+                await asyncio.sleep(0.001)
+                delivered.append(offset)
+                yield PAYLOAD[offset:min(offset + CHUNK, end + 1)]
+
+        fanout = StreamFanout(buffer_bytes=64 * 1024, read_ahead=32 * 1024)
+        stream = fanout.fetcher("k", fetch)(0, len(PAYLOAD) - 1)
+        await stream.__anext__()
+        await stream.aclose()
+        await asyncio.sleep(0.05)
+        assert fanout.get_stats()["active_upstreams"] == 0
+        assert len(delivered) < len(PAYLOAD) // CHUNK
+    asyncio.run(scenario())
+
+def test_slow_listener_detaches_onto_its_own_connection():
+    async def scenario():
+        opened = []
+        fanout = StreamFanout(buffer_bytes=64 * 1024, read_ahead=32 * 1024)
+        fetch = fanout.fetcher("k", source(opened, delay=0))
+        fast, slow = await asyncio.gather(
+            read(fetch, 0, len(PAYLOAD) - 1), read(fetch, 0, len(PAYLOAD) - 1, delay=0.005))
+        assert fast == PAYLOAD
+        assert slow == PAYLOAD
+        assert fanout.stats["detached"] == 1
+        assert len(opened) == 2 and opened[1][0] > 0 and opened[1][1] == len(PAYLOAD) - 1
+    asyncio.run(scenario())